@@ -0,0 +1,364 @@
+'''
+Offline throughput benchmark of the migration in cloud.py.
+
+GCS, the SQLCE store and Cloud SQL are replaced by local stand-ins: the directory-backed LocalBackend
+of storage_backend.py, and SQLite databases created from create_tables.sql for both the source and the destination.
+A synthetic job tree of BMP stacks is generated, uploaded with upload_data, downloaded again
+with download_from_cloud, and the rows are inserted a second time with insert_data_into_mysql.
+
+    python benchmark.py --jobs 4 --wells 6 --repetitions 2 --z 10 --size 512 512 --json report.json
+
+Reports files/s, MB/s, rows/s and latency percentiles of every stage.
+'''
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import logging
+import argparse
+import tempfile
+from collections import defaultdict
+import numpy as np
+import cloud
+from replica import sqlite_schema, SCHEMA_FILE
+from storage_backend import LocalBackend
+
+
+# stand-in for Cloud SQL
+class SQLiteMySQLCursor:
+    '''
+    SQLite cursor taking the MySQL dialect cloud.py writes: %s placeholders and INSERT IGNORE.
+    '''
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    @staticmethod
+    def translate(query):
+        query = query.replace('%s', '?')
+        return re.sub(r'^\s*INSERT IGNORE INTO', 'INSERT OR IGNORE INTO', query, flags=re.IGNORECASE)
+
+    def execute(self, query, params=()):
+        self.cursor.execute(self.translate(query), params)
+
+    def executemany(self, query, seq_of_params):
+        self.cursor.executemany(self.translate(query), seq_of_params)
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchmany(self, size=1):
+        return self.cursor.fetchmany(size)
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    @property
+    def description(self):
+        return self.cursor.description
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+    def close(self):
+        self.cursor.close()
+
+
+class SQLiteMySQLConnection:
+    def __init__(self, filename):
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+
+    def cursor(self):
+        return SQLiteMySQLCursor(self.connection.cursor())
+
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+    def ping(self, reconnect=False, attempts=1, delay=0):
+        self.connection.execute("SELECT 1")
+
+    def is_connected(self):
+        return True
+
+    def close(self):
+        self.connection.close()
+
+
+class QuietMessagebox:
+    '''
+    download_from_cloud reports through tkinter message boxes, the benchmark just counts them.
+    '''
+
+    def __init__(self):
+        self.shown = []
+
+    def showinfo(self, title, message):
+        self.shown.append((title, message))
+
+    showwarning = showerror = showinfo
+
+
+# synthetic data
+def write_bmp(path, image):
+    '''
+    8-bit grayscale BMP without cv2: headers, a grey palette and bottom-up rows padded to 4 bytes.
+    '''
+    height, width = image.shape
+    row_size = (width + 3) & ~3
+    pixels = np.zeros((height, row_size), dtype=np.uint8)
+    pixels[:, :width] = image[::-1]
+    offset = 14 + 40 + 256 * 4
+    header = b'BM' + (offset + pixels.size).to_bytes(4, 'little') + bytes(4) + offset.to_bytes(4, 'little')
+    info = (40).to_bytes(4, 'little') + width.to_bytes(4, 'little') + height.to_bytes(4, 'little') + \
+        (1).to_bytes(2, 'little') + (8).to_bytes(2, 'little') + bytes(4) + pixels.size.to_bytes(4, 'little') + \
+        (2835).to_bytes(4, 'little') * 2 + (256).to_bytes(4, 'little') + bytes(4)
+    palette = np.repeat(np.arange(256, dtype=np.uint8), 4).reshape(256, 4)
+    palette[:, 3] = 0
+    with open(path, 'wb') as f:
+        f.write(header + info + palette.tobytes() + pixels.tobytes())
+
+def well_names(count):
+    return [f"{'ABCDEFGH'[index // 12 % 8]}{index % 12 + 1}" for index in range(count)]
+
+def seed_source(filename, jobs, wells, repetitions, events=20):
+    '''
+    SQLite stand-in for the SQLCE store, rows linked the way generate_paths and CHILD_TABLES expect them.
+    return: the open connection
+    '''
+    connection = sqlite3.connect(filename, check_same_thread=False)
+    with open(SCHEMA_FILE) as f:
+        connection.executescript(sqlite_schema(f.read()))
+    for job_id in range(1, jobs + 1):
+        connection.execute("INSERT INTO Job (Id, Name, Status, ModifiedTimeUtc) VALUES (?, ?, 'Complete', datetime('now'))",
+                           (job_id, f"bench plate {job_id}"))
+        connection.execute("INSERT INTO JobTask (Id, Job_id, OrderIndex) VALUES (?, ?, 0)", (job_id, job_id))
+        connection.execute("INSERT INTO AcquireTask (JobTask_id, AcquireSettings_id, UsedRepetitions) VALUES (?, ?, ?)",
+                           (job_id, job_id, repetitions))
+        connection.execute("INSERT INTO AcquireSettings (Id, NumberOfRepetitions, OriginalAcquireTask_id) VALUES (?, ?, ?)",
+                           (job_id, repetitions, job_id))
+        connection.execute("INSERT INTO InstrumentInformation (Id, Name, SoftwareVersion) VALUES (?, 'bench', '0')", (job_id,))
+        connection.executemany("INSERT INTO JobEvent (Id, Job_id, Description, Category, TimestampUtc) VALUES (?, ?, ?, 'Info', datetime('now'))",
+                               [((job_id - 1) * events + index + 1, job_id, f"event {index}") for index in range(events)])
+        connection.executemany("INSERT INTO ScanArea (Id, Name, OrderIndex, Enabled, AcquireSettings_id) VALUES (?, ?, ?, 1, ?)",
+                               [((job_id - 1) * wells + order + 1, name, order, job_id) for order, name in enumerate(well_names(wells))])
+    connection.commit()
+    return connection
+
+def create_destination(filename):
+    connection = SQLiteMySQLConnection(filename)
+    with open(SCHEMA_FILE) as f:
+        connection.connection.executescript(sqlite_schema(f.read()))
+    connection.commit()
+    return connection
+
+def build_job_trees(workdir, jobs, wells, repetitions, z, size, seed=0):
+    '''
+    <job>/Acquire_0/<OrderIndex>/<repetition>/<z>.bmp plus an e96_wells file per job, noise images.
+    return: files and bytes written
+    '''
+    rng = np.random.default_rng(seed)
+    files = total = 0
+    for job_id in range(1, jobs + 1):
+        for order in range(wells):
+            for repetition in range(repetitions):
+                folder = os.path.join(workdir, str(job_id), "Acquire_0", str(order), str(repetition))
+                os.makedirs(folder, exist_ok=True)
+                for level in range(z):
+                    path = os.path.join(folder, f"{level}.bmp")
+                    write_bmp(path, rng.integers(0, 256, size, dtype=np.uint8))
+                    files += 1
+                    total += os.path.getsize(path)
+        with open(os.path.join(workdir, str(job_id), "Acquire_0", "e96_wells"), 'wb') as f:
+            f.write(rng.bytes(4096))
+    return files, total
+
+
+# measurement
+class StageTimer:
+    '''
+    Wraps module functions to record the duration of every call, per stage.
+    '''
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self._originals = []
+
+    def wrap(self, module, name, stage=None):
+        func = getattr(module, name)
+        samples = self.samples[stage or name]
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                samples.append(time.perf_counter() - start)
+
+        self._originals.append((module, name, func))
+        setattr(module, name, timed)
+
+    def restore(self):
+        for module, name, func in reversed(self._originals):
+            setattr(module, name, func)
+        self._originals.clear()
+
+    def summary(self):
+        '''
+        return: stage -> calls, total seconds and p50/p90/p99/max latency in milliseconds
+        '''
+        report = {}
+        for stage, samples in self.samples.items():
+            if not samples:
+                continue
+            milliseconds = np.asarray(samples) * 1000
+            p50, p90, p99 = np.percentile(milliseconds, [50, 90, 99])
+            report[stage] = {'calls': len(samples), 'total_s': round(float(milliseconds.sum()) / 1000, 4),
+                             'p50_ms': round(float(p50), 3), 'p90_ms': round(float(p90), 3),
+                             'p99_ms': round(float(p99), 3), 'max_ms': round(float(milliseconds.max()), 3)}
+        return report
+
+def rate(count, seconds):
+    return round(count / seconds, 2) if seconds > 0 else None
+
+def directory_size(root):
+    files = total = 0
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            files += 1
+            total += os.path.getsize(os.path.join(dirpath, filename))
+    return files, total
+
+def run_benchmark(workdir, jobs=4, wells=6, repetitions=2, z=10, size=(512, 512), workers=8, batch_size=500, verify_crc=False):
+    '''
+    Generate the data set, then time the upload, the download and a separate row insert.
+    return: report dict
+    '''
+    logger = logging.getLogger('benchmark')
+    bucket_name = "benchmark"
+    source_dir = os.path.join(workdir, "source")
+    download_dir = os.path.join(workdir, "download")
+    for folder in (source_dir, download_dir):
+        os.makedirs(folder, exist_ok=True)
+
+    files, total = build_job_trees(source_dir, jobs, wells, repetitions, z, size)
+    source = seed_source(os.path.join(workdir, "sqlce.db"), jobs, wells, repetitions)
+    destination = create_destination(os.path.join(workdir, "mysql.db"))
+    storage_client = LocalBackend(os.path.join(workdir, "bucket"))
+
+    timer = StageTimer()
+    for name in ("extract_job_bundles", "generate_paths", "copy_to_cloud", "upload_file", "store_paths",
+                 "insert_bundle_into_mysql", "insert_data_into_mysql", "download_from_cloud", "download_blob"):
+        timer.wrap(cloud, name)
+    patched = [(cloud, "messagebox", QuietMessagebox())]
+    originals = [(module, name, getattr(module, name)) for module, name, _ in patched]
+    for module, name, value in patched:
+        setattr(module, name, value)
+    cloud.mysql_connection = destination
+
+    cwd = os.getcwd()
+    report = {'dataset': {'jobs': jobs, 'wells': wells, 'repetitions': repetitions, 'z': z, 'size': list(size),
+                          'files': files, 'MB': round(total / 1e6, 2)}}
+    try:
+        # upload: files to the local bucket and every row to the destination, paths are relative to the job tree
+        os.chdir(source_dir)
+        destination_cursor = destination.cursor()
+        start = time.perf_counter()
+        upload = cloud.upload_data(destination, destination_cursor, source, source.cursor(), None, bucket_name,
+                                   "sqlce.db", logger, workers=workers, verify_crc=verify_crc, batch_size=batch_size,
+                                   bulk_extract=True, progress_file=os.path.join(workdir, "last_uploaded.txt"),
+                                   storage_client=storage_client)
+        seconds = time.perf_counter() - start
+        uploaded_files, uploaded_bytes = directory_size(os.path.join(workdir, "bucket", bucket_name))
+        report['upload'] = {'seconds': round(seconds, 3), 'jobs': len(upload['inserted']), 'failed_jobs': len(upload['failed']),
+                            'files_per_s': rate(uploaded_files, seconds), 'MB_per_s': rate(uploaded_bytes / 1e6, seconds)}
+
+        # download: into an empty tree, so every file is transferred
+        os.chdir(download_dir)
+        start = time.perf_counter()
+        downloaded = failed = 0
+        for job_id in range(1, jobs + 1):
+            summary = cloud.download_from_cloud(job_id, None, bucket_name, destination_cursor, logger,
+                                                storage_client=storage_client, workers=workers, verify_crc=verify_crc)
+            downloaded += len(summary['downloaded'])
+            failed += len(summary['failed'])
+        seconds = time.perf_counter() - start
+        _, downloaded_bytes = directory_size(download_dir)
+        report['download'] = {'seconds': round(seconds, 3), 'files': downloaded, 'failed': failed,
+                              'files_per_s': rate(downloaded, seconds), 'MB_per_s': rate(downloaded_bytes / 1e6, seconds)}
+
+        # rows: the child tables of every job again, row by row and batched, into fresh destinations
+        for mode, mode_batch_size in (("row", None), ("batched", batch_size)):
+            target = create_destination(os.path.join(workdir, f"mysql_{mode}.db"))
+            cloud.mysql_connection = target
+            target_cursor = target.cursor()
+            source_cursor = source.cursor()
+            rows = 0
+            start = time.perf_counter()
+            for job_id in range(1, jobs + 1):
+                for table, column in cloud.CHILD_TABLES:
+                    rows += cloud.insert_data_into_mysql(source_cursor, target_cursor, table, column, job_id, mode_batch_size,
+                                                         connection=target)
+                target.commit()
+            seconds = time.perf_counter() - start
+            report[f'insert_{mode}'] = {'seconds': round(seconds, 3), 'rows': rows, 'rows_per_s': rate(rows, seconds)}
+            target.close()
+    finally:
+        os.chdir(cwd)
+        timer.restore()
+        for module, name, value in originals:
+            setattr(module, name, value)
+        source.close()
+        destination.close()
+        storage_client.close()
+
+    report['stages'] = timer.summary()
+    return report
+
+def print_report(report):
+    dataset = report['dataset']
+    print(f"{dataset['jobs']} jobs, {dataset['files']} images, {dataset['MB']} MB")
+    for name in ('upload', 'download', 'insert_row', 'insert_batched'):
+        print(f"{name:<16}" + ', '.join(f"{key} {value}" for key, value in report[name].items()))
+    print(f"\n{'stage':<26}{'calls':>8}{'total s':>10}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for stage, stats in report['stages'].items():
+        print(f"{stage:<26}{stats['calls']:>8}{stats['total_s']:>10}{stats['p50_ms']:>10}{stats['p90_ms']:>10}"
+              f"{stats['p99_ms']:>10}{stats['max_ms']:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the data migration.")
+    parser.add_argument("--jobs", type=int, default=4)
+    parser.add_argument("--wells", type=int, default=6, help="enabled scan areas per job")
+    parser.add_argument("--repetitions", type=int, default=2)
+    parser.add_argument("--z", type=int, default=10, help="images per repetition")
+    parser.add_argument("--size", type=int, nargs=2, default=(512, 512), metavar=("HEIGHT", "WIDTH"))
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--verify-crc", action="store_true")
+    parser.add_argument("--workdir", help="kept after the run, a temporary folder is used and removed if not set")
+    parser.add_argument("--json", help="write the report to this file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    workdir = args.workdir or tempfile.mkdtemp(prefix="metdb_benchmark_")
+    try:
+        report = run_benchmark(os.path.abspath(workdir), args.jobs, args.wells, args.repetitions, args.z, tuple(args.size),
+                               args.workers, args.batch_size, args.verify_crc)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=4)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,10 +1,22 @@
 import os
 import logging
-import adodbapi
 import mysql.connector
-from google.cloud import storage
 import json
 import argparse
+import time
+import re
+import datetime
+import asyncio
+from journal import open_journal, UploadJournal, PENDING, UPLOADED, VERIFIED, INSERTED, EMPTY
+from manifest import open_manifest
+from pack import upload_pack, download_pack, index_name, pack_prefix
+from preview import build_previews, preview_cloud_path
+from focus import score_scan_areas
+from db_pool import connect_pool, ensure_connected, is_transient, local_infile_options
+from replica import open_replica, escape_like, fulltext_words
+from metrics import METRICS, timed
+from storage_backend import GCSBackend, open_storage, file_crc32c
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
 import tkinter as tk
 from tkinter import ttk
 from tkinter import messagebox
@@ -58,15 +70,27 @@ def update_last_uploaded_job_id(job_id, filename='last_uploaded.txt'):
     with open(filename, 'w') as f:
         f.write(str(job_id))
 
-def connect_to_mysql(host, db_name, user, password):
+def advance_last_uploaded_job_id(job_id, failed, filename='last_uploaded.txt'):
+    '''
+    Move the high-water mark to job_id, but never past the lowest failed job id,
+    so a run without a journal picks the failed job up again next time.
+    failed: job ids that failed in this run
+    '''
+    if failed and job_id > min(failed):
+        return
+    update_last_uploaded_job_id(job_id, filename=filename)
+
+def connect_to_mysql(host, db_name, user, password, local_infile_dir=None):
     ''' 
     Connect to MySQL and return the connection and cursor.
+    local_infile_dir: only directory LOAD DATA LOCAL INFILE may read from, the Scan staging folder
     '''
     mysql_connection = mysql.connector.connect(
         host=host,
         database=db_name,
         user=user,
-        password=password
+        password=password,
+        **local_infile_options(local_infile_dir)
     )
 
     if not mysql_connection.is_connected():
@@ -80,12 +104,15 @@ def connect_to_sqlce(data_source):
     Connect to SQLCE and return the connection and cursor.
     '''
     conn_str = f'Provider=Microsoft.SQLSERVER.CE.OLEDB.4.0; Data Source={data_source};'
+    # imported here, adodbapi only installs on Windows where the SQL CE provider is
+    import adodbapi
     sqlce_connection = adodbapi.connect(conn_str)
     sqlce_connection.connector.CursorLocation = 2  # Adjusting CursorLocation for buffered mode
     sqlce_cursor = sqlce_connection.cursor()
     return sqlce_connection, sqlce_cursor
 
 
+@timed("generate_paths", job="job_id", measure=lambda paths: {'items': len(paths[0])})
 def generate_paths(cursor, job_id, job_name):
     '''
     generate path from SQLCE with job_id
@@ -97,10 +124,18 @@ def generate_paths(cursor, job_id, job_name):
     cursor.execute(related_query)
     related_records = cursor.fetchall()
 
+    return build_paths(job_id, job_name, related_records)
+
+def build_paths(job_id, job_name, scan_areas):
+    '''
+    recreate local and cloud paths from (name, OrderIndex) pairs of the enabled scan areas
+    return: list of local paths, list of cloud paths
+    '''
+
     local_paths = []
     cloud_paths = []
 
-    for related_record in related_records:
+    for related_record in scan_areas:
         scan_name = related_record[0]
         order_index = related_record[1]
 
@@ -120,44 +155,358 @@ def generate_paths(cursor, job_id, job_name):
     return local_paths, cloud_paths
 
 
+@timed("extract_job_bundles", measure=lambda extracted: {'items': len(extracted[0])})
+def extract_job_bundles(cursor, last_uploaded_id=0, max_jobs=None, shard=None):
+    '''
+    Read Job and every child table from SQLCE once, filtered to ids above last_uploaded_id,
+    and group the rows in memory by the column that ties them to a job.
+    This replaces the ~8 queries per job issued by generate_paths and insert_data_into_mysql.
+    max_jobs: only extract the next max_jobs jobs, the child tables are limited to their id range
+    shard: only extract the jobs of this shard, see job_in_shard
+    return: dict of job_id -> bundle, dict of table -> column names
+            a bundle holds 'job' (row), 'rows' (table -> list of rows),
+            'local_paths' and 'cloud_paths'
+    '''
 
-
-def store_paths(destination_cursor, job_id, local_path, cloud_path):
-    """Store local and cloud paths in the PathStorage table."""
-    insert_query = "INSERT INTO PathStorage (job_id, local_path, cloud_path) VALUES (%s, %s, %s)"
+    condition, params = shard_condition("Id", shard)
+    if max_jobs:
+        cursor.execute(f"SELECT TOP ({int(max_jobs)}) * FROM Job WHERE Id > ?{condition} ORDER BY Id", (last_uploaded_id, *params))
+    else:
+        cursor.execute(f"SELECT * FROM Job WHERE Id > ?{condition} ORDER BY Id", (last_uploaded_id, *params))
+    jobs = cursor.fetchall()
+    columns = {"Job": [description[0] for description in cursor.description]}
+    if max_jobs and not jobs:
+        return {}, columns
+
+    bundles = {}
+    for job in jobs:
+        job = list(job)
+        bundles[job[0]] = {'job': job, 'rows': {table: [] for table, _ in CHILD_TABLES}}
+
+    for table, column in CHILD_TABLES:
+        condition, params = shard_condition(column, shard)
+        if max_jobs:
+            cursor.execute(f"SELECT * FROM {table} WHERE {column} > ? AND {column} <= ?{condition}",
+                           (last_uploaded_id, jobs[-1][0], *params))
+        else:
+            cursor.execute(f"SELECT * FROM {table} WHERE {column} > ?{condition}", (last_uploaded_id, *params))
+        records = cursor.fetchall()
+        columns[table] = [description[0] for description in cursor.description]
+        key_index = [name.lower() for name in columns[table]].index(column.lower())
+        for record in records:
+            bundle = bundles.get(record[key_index])
+            if bundle is not None:
+                bundle['rows'][table].append(list(record))
+
+    scan_area_columns = [name.lower() for name in columns["ScanArea"]]
+    name_index = scan_area_columns.index("name")
+    order_index = scan_area_columns.index("orderindex")
+    enabled_index = scan_area_columns.index("enabled")
+    for job_id, bundle in bundles.items():
+        scan_areas = [(row[name_index], row[order_index]) for row in bundle['rows']["ScanArea"] if row[enabled_index]]
+        bundle['local_paths'], bundle['cloud_paths'] = build_paths(job_id, bundle['job'][1], scan_areas)
+
+    return bundles, columns
+
+
+def migrate_path_storage(mysql_connection, mysql_cursor):
+    '''
+    Add PathStorage.level and its index to a database created before preview levels,
+    the rows already there are the full resolution data, level 0.
+    return: True if the table was altered
+    '''
+    mysql_cursor.execute("SELECT COUNT(*) FROM information_schema.COLUMNS "
+                         "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'PathStorage' AND COLUMN_NAME = 'level'")
+    if mysql_cursor.fetchone()[0]:
+        return False
+    mysql_cursor.execute("ALTER TABLE PathStorage ADD COLUMN level INT NOT NULL DEFAULT 0, "
+                         "ADD INDEX IX_PathStorage_Job (job_id, level)")
+    mysql_connection.commit()
+    return True
+
+# indexes search_jobs relies on, by name
+JOB_SEARCH_INDEXES = {
+    "IX_Job_Name": "CREATE INDEX IX_Job_Name ON Job (Name)",
+    "FT_Job_Name": "CREATE FULLTEXT INDEX FT_Job_Name ON Job (Name)",
+}
+
+def migrate_job_search(mysql_connection, mysql_cursor):
+    '''
+    Add the Job.Name indexes of the 'prefix' and 'fulltext' job searches to a database created without them.
+    return: names of the indexes that were created
+    '''
+    placeholders = ', '.join(['%s'] * len(JOB_SEARCH_INDEXES))
+    mysql_cursor.execute("SELECT DISTINCT INDEX_NAME FROM information_schema.STATISTICS "
+                         f"WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'Job' AND INDEX_NAME IN ({placeholders})",
+                         tuple(JOB_SEARCH_INDEXES))
+    existing = {row[0] for row in mysql_cursor.fetchall()}
+    created = []
+    for name, statement in JOB_SEARCH_INDEXES.items():
+        if name not in existing:
+            mysql_cursor.execute(statement)
+            created.append(name)
+    mysql_connection.commit()
+    return created
+
+@timed("store_paths", job="job_id", measure=lambda _: {'items': 1})
+def store_paths(destination_cursor, job_id, local_path, cloud_path, level=0, connection=None):
+    """Store local and cloud paths in the PathStorage table.
+    level: 0 for full resolution data, otherwise the downsampling factor of a preview.
+    connection: connection of destination_cursor, defaults to the global mysql_connection."""
+    insert_query = "INSERT INTO PathStorage (job_id, local_path, cloud_path, level) VALUES (%s, %s, %s, %s)"
     try:
-        destination_cursor.execute(insert_query, (job_id, local_path, cloud_path))
-        mysql_connection.commit()
+        destination_cursor.execute(insert_query, (job_id, local_path, cloud_path, level))
+        (connection or mysql_connection).commit()
     except Exception as e:
+        if is_transient(e):
+            raise
         print(f"Error storing paths for job_id {job_id}: {e}")
 
+# child tables of a job and the column their rows are selected by
+CHILD_TABLES = [
+    ("JobTask", "Job_id"),
+    ("JobEvent", "Job_id"),
+    ("AcquireTask", "JobTask_id"),
+    ("AcquireSettings", "OriginalAcquireTask_id"),
+    ("InstrumentInformation", "Id"),
+    ("ScanArea", "AcquireSettings_id"),
+]
+
+def build_insert_query(table, n_values, columns=None, on_duplicate=None):
+    '''
+    Build the INSERT statement for a table once so it can be reused for every row.
+    on_duplicate: None for a plain INSERT, 'ignore' for INSERT IGNORE,
+                  'update' for ON DUPLICATE KEY UPDATE (needs columns)
+    '''
+    placeholders = ', '.join(['%s'] * n_values)
+    if on_duplicate == 'ignore':
+        return f"INSERT IGNORE INTO {table} VALUES ({placeholders})"
+    if on_duplicate == 'update':
+        if not columns:
+            raise ValueError(f"Column names are required for ON DUPLICATE KEY UPDATE on {table}")
+        updates = ', '.join(f"{column}=VALUES({column})" for column in columns)
+        return f"INSERT INTO {table} VALUES ({placeholders}) ON DUPLICATE KEY UPDATE {updates}"
+    return f"INSERT INTO {table} VALUES ({placeholders})"
+
+def insert_rows_into_mysql(destination_cursor, table, records, batch_size=500, columns=None, on_duplicate='ignore'):
+    '''
+    Insert records with executemany in chunks of batch_size.
+    mysql.connector rewrites each chunk into one multi-row VALUES statement.
+    Nothing is committed here, the caller owns the transaction.
+    return: number of rows sent
+    '''
+    if not records:
+        return 0
+    records = [list(record) for record in records]
+    insert_query = build_insert_query(table, len(records[0]), columns, on_duplicate)
+    for start in range(0, len(records), batch_size):
+        destination_cursor.executemany(insert_query, records[start:start + batch_size])
+    return len(records)
+
 # insert_data_into_mysql function and connection code 
-def insert_data_into_mysql(source_cursor, destination_cursor, table, column, job_id):
+@timed("insert_data_into_mysql", job="job_id", measure=lambda rows: {'items': rows})
+def insert_data_into_mysql(source_cursor, destination_cursor, table, column, job_id, batch_size=None, on_duplicate='ignore', connection=None):
     '''
     source_cursor: the SQLCE cursor where the data from
     destination_cursor: the google MySQL cursor where the date insert
     table: table name 
     job_id: index
+    batch_size: None inserts and commits row by row, otherwise rows are sent in batches
+                of this size and the commit is left to the caller
+    on_duplicate: 'ignore' or 'update', only used in batched mode
+    connection: connection of destination_cursor, defaults to the global mysql_connection
 
     '''
 
     source_cursor.execute(f"SELECT * FROM {table} WHERE {column} = {job_id}")
     records = source_cursor.fetchall()
 
+    if batch_size:
+        columns = [description[0] for description in source_cursor.description]
+        return insert_rows_into_mysql(destination_cursor, table, records, batch_size, columns, on_duplicate)
+
+    insert_query = None
     for record in records:
         record = list(record)
-        insert_query = f"INSERT INTO {table} VALUES ({', '.join(['%s'] * len(record))})"
+        if insert_query is None:
+            insert_query = build_insert_query(table, len(record))
         
         try:
             destination_cursor.execute(insert_query, record)
-            mysql_connection.commit()
+            (connection or mysql_connection).commit()
         except mysql.connector.IntegrityError as ie:
             print(f"Error inserting into {table}: {ie}")
             continue
+    return len(records)
+
+def insert_job_into_mysql(mysql_connection, source_cursor, destination_cursor, job, job_columns=None, batch_size=500, on_duplicate='ignore'):
+    '''
+    Insert a job row and all of its child tables in one transaction.
+    Either every row of the job lands or none does.
+    job_columns: column names of the Job row, needed when on_duplicate is 'update'
+    return: dict of table -> rows sent
+    '''
+    job_id = job[0]
+    counts = {}
+    try:
+        counts["Job"] = insert_rows_into_mysql(destination_cursor, "Job", [job], batch_size, job_columns, on_duplicate)
+        for table, column in CHILD_TABLES:
+            counts[table] = insert_data_into_mysql(source_cursor, destination_cursor, table, column, job_id, batch_size, on_duplicate)
+        mysql_connection.commit()
+    except Exception:
+        mysql_connection.rollback()
+        raise
+    return counts
+
+@timed("insert_bundle_into_mysql", job=lambda arguments: arguments['bundle']['job'][0],
+       measure=lambda counts: {'items': sum(counts.values())})
+def insert_bundle_into_mysql(mysql_connection, destination_cursor, bundle, columns, batch_size=500, on_duplicate='ignore'):
+    '''
+    Insert an extracted job bundle in one transaction, no SQLCE queries needed.
+    return: dict of table -> rows sent
+    '''
+    counts = {}
+    try:
+        counts["Job"] = insert_rows_into_mysql(destination_cursor, "Job", [bundle['job']], batch_size, columns["Job"], on_duplicate)
+        for table, _ in CHILD_TABLES:
+            counts[table] = insert_rows_into_mysql(destination_cursor, table, bundle['rows'][table], batch_size, columns[table], on_duplicate)
+        mysql_connection.commit()
+    except Exception:
+        mysql_connection.rollback()
+        raise
+    return counts
+
+def job_scan_area_ids(sqlce_cursor, job_id, bundle=None, columns=None):
+    '''
+    Ids of every scan area of a job, enabled or not, the keys its Scan rows hang off.
+    '''
+    if bundle is not None:
+        id_index = [name.lower() for name in columns["ScanArea"]].index("id")
+        return [row[id_index] for row in bundle['rows']["ScanArea"]]
+    sqlce_cursor.execute("SELECT Id FROM ScanArea WHERE AcquireSettings_id = ?", (job_id,))
+    return [row[0] for row in sqlce_cursor.fetchall()]
 
-def list_buckets(service_account_file):
+def staging_value(value):
+    '''
+    One field of a LOAD DATA file: NULL as \\N, tabs, newlines and backslashes escaped.
+    '''
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat(' ')
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+STAGING_ESCAPES = {'t': '\t', 'n': '\n'}
+
+def parse_staging_line(line):
+    '''
+    Fields of one staged line, for the INSERT fallback of load_scan_file.
+    '''
+    fields = line.rstrip('\n').split('\t')
+    return [None if field == '\\N' else re.sub(r'\\(.)', lambda match: STAGING_ESCAPES.get(match.group(1), match.group(1)), field)
+            for field in fields]
+
+def stage_job_scans(sqlce_cursor, job_id, scan_area_ids, staging_dir="scan_staging", chunk_size=10000, ids_per_query=500):
+    '''
+    Stream the Scan rows of a job out of SQLCE into a tab-separated staging file for LOAD DATA.
+    Rows are fetched and written chunk_size at a time, so a long time-lapse is never held in memory.
+    return: (staging file, column names, rows written)
+    '''
+    os.makedirs(staging_dir, exist_ok=True)
+    staging_file = os.path.join(staging_dir, f"scan_{job_id}.tsv")
+    columns = None
+    count = 0
+    with open(staging_file, 'w', newline='\n', encoding='utf-8') as f:
+        for start in range(0, len(scan_area_ids), ids_per_query):
+            ids = scan_area_ids[start:start + ids_per_query]
+            sqlce_cursor.execute(f"SELECT * FROM Scan WHERE ScanArea_id IN ({', '.join(['?'] * len(ids))})", ids)
+            columns = columns or [description[0] for description in sqlce_cursor.description]
+            while True:
+                rows = sqlce_cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                f.writelines('\t'.join(staging_value(value) for value in row) + '\n' for row in rows)
+                count += len(rows)
+    return staging_file, columns, count
+
+@timed("load_scan_file", measure=lambda rows: {'items': rows})
+def load_scan_file(mysql_connection, destination_cursor, staging_file, columns, on_duplicate='ignore', batch_size=500):
+    '''
+    Bulk load a staged Scan file with LOAD DATA LOCAL INFILE in one transaction.
+    If the server or the connection does not allow local infiles, the file is sent
+    with batched multi-row INSERTs instead.
+    return: number of rows loaded
+    '''
+    duplicate = 'REPLACE' if on_duplicate == 'update' else 'IGNORE'
+    query = (f"LOAD DATA LOCAL INFILE %s {duplicate} INTO TABLE Scan "
+             "FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' LINES TERMINATED BY '\\n' "
+             f"({', '.join(columns)})")
+    try:
+        try:
+            destination_cursor.execute(query, (os.path.abspath(staging_file),))
+            loaded = destination_cursor.rowcount
+        except mysql.connector.Error as e:
+            # 1148/3948: local infile disabled on the server, 2068: refused by the client
+            if e.errno not in (1148, 2068, 3948):
+                raise
+            loaded = 0
+            with open(staging_file, encoding='utf-8') as f:
+                while True:
+                    records = [parse_staging_line(line) for _, line in zip(range(batch_size * 20), f)]
+                    if not records:
+                        break
+                    loaded += insert_rows_into_mysql(destination_cursor, "Scan", records, batch_size, columns, on_duplicate)
+        mysql_connection.commit()
+    except Exception:
+        mysql_connection.rollback()
+        raise
+    return loaded
+
+def scan_area_paths(sqlce_cursor, job_id, bundle=None, columns=None):
+    '''
+    Enabled scan areas of a job with their local folders, taken from an extracted bundle when there is one.
+    return: list of (scan_area_id, local_path)
+    '''
+    if bundle is not None:
+        names = [name.lower() for name in columns["ScanArea"]]
+        id_index, order_index, enabled_index = names.index("id"), names.index("orderindex"), names.index("enabled")
+        records = [(row[id_index], row[order_index]) for row in bundle['rows']["ScanArea"] if row[enabled_index]]
+    else:
+        sqlce_cursor.execute("SELECT Id, OrderIndex FROM ScanArea WHERE AcquireSettings_id = ? AND Enabled = 1", (job_id,))
+        records = sqlce_cursor.fetchall()
+    return [(record[0], os.path.join(str(job_id), "Acquire_0", str(record[1]))) for record in records]
+
+def store_optimal_z_levels(mysql_connection, destination_cursor, rows, batch_size=500):
+    '''
+    Write the best z of every (ScanArea_id, RepetitionIndex) into Scan.OptimalZLevel in bulk.
+    The rows are loaded into a temporary table with multi-row inserts and applied with one
+    UPDATE ... JOIN, instead of one UPDATE per repetition.
+    rows: list of (scan_area_id, repetition_index, optimal_z_level)
+    return: number of Scan rows changed
+    '''
+    if not rows:
+        return 0
+    try:
+        destination_cursor.execute("CREATE TEMPORARY TABLE IF NOT EXISTS OptimalZ "
+                                   "(ScanArea_id INT, RepetitionIndex INT, OptimalZLevel INT, PRIMARY KEY (ScanArea_id, RepetitionIndex))")
+        destination_cursor.execute("DELETE FROM OptimalZ")
+        insert_rows_into_mysql(destination_cursor, "OptimalZ", rows, batch_size, on_duplicate='ignore')
+        destination_cursor.execute("UPDATE Scan JOIN OptimalZ ON Scan.ScanArea_id = OptimalZ.ScanArea_id "
+                                   "AND Scan.RepetitionIndex = OptimalZ.RepetitionIndex "
+                                   "SET Scan.OptimalZLevel = OptimalZ.OptimalZLevel")
+        updated = destination_cursor.rowcount
+        mysql_connection.commit()
+    except Exception:
+        mysql_connection.rollback()
+        raise
+    return updated
+
+def list_buckets(service_account_file, storage_client=None):
     # Instantiates a storage client with the service account file
-    storage_client = storage.Client.from_service_account_json(service_account_file)
+    if storage_client is None:
+        storage_client = get_storage_client(service_account_file)
 
     # Lists all the buckets
     buckets = list(storage_client.list_buckets())
@@ -165,7 +514,74 @@ def list_buckets(service_account_file):
     for bucket in buckets:
         print(bucket.name)
 
-def copy_to_cloud(local_path, cloud_path, service_account_file_path, bucket_name, job_id):
+def get_storage_client(service_account_file_path):
+    '''
+    Create one GCS backend for the whole run.
+    Its client keeps its own HTTP connection pool and is safe to share between upload threads.
+    '''
+    return GCSBackend(service_account_file_path)
+
+def storage_from_config(config):
+    '''
+    Storage backend of the run from config.json, GCS unless storage_backend is 'local'.
+    '''
+    return open_storage(config.get("storage_backend", "gcs"), config.get("service_account_file_path"),
+                        root=config.get("storage_root"), chunk_bytes=config.get("transfer_chunk_mb", 32) * 1024 * 1024,
+                        workers=config.get("transfer_workers", 8))
+
+def list_cloud_prefix(bucket, cloud_path):
+    '''
+    List every object under cloud_path once instead of asking blob.exists() per file.
+    list_blobs pages through the prefix in a few requests (1000 objects per page).
+    return: dict of blob name -> blob, its crc32c is only read when it is compared
+    '''
+    prefix = cloud_path.replace('\\', '/').rstrip('/') + '/'
+    return {blob.name: blob for blob in bucket.list_blobs(prefix=prefix)}
+
+def needs_upload(local_file, cloud_file_path, existing, verify_crc=False, manifest=None):
+    '''
+    Diff one local file against the prefix listing.
+    manifest: ContentManifest, reuses the cached crc32c of files whose stat did not change.
+    return: None if the object is missing, 'match' if it is complete,
+            'mismatch' if the stored object is truncated or has a different checksum.
+    '''
+    if cloud_file_path not in existing:
+        return None
+    blob = existing[cloud_file_path]
+    if blob.size != os.path.getsize(local_file):
+        return 'mismatch'
+    if verify_crc and blob.crc32c:
+        local_crc32c = manifest.crc32c(local_file) if manifest is not None else file_crc32c(local_file)
+        if blob.crc32c != local_crc32c:
+            return 'mismatch'
+    return 'match'
+
+def upload_file(bucket, local_file, cloud_file_path, retries=3, storage_client=None):
+    '''
+    Upload a single file, retrying it on its own if the transfer fails.
+    storage_client: backend the file goes through, so large files are sent in parallel chunks
+    return: (status, error, blob) where status is 'uploaded' or 'failed',
+            the blob carries the generation and crc32c returned by GCS
+    '''
+    blob = bucket.blob(cloud_file_path)
+    error = None
+    for attempt in range(1, retries + 1):
+        try:
+            if storage_client is not None:
+                blob = storage_client.upload(bucket, local_file, cloud_file_path)
+            else:
+                blob.upload_from_filename(local_file)
+            return 'uploaded', None, blob
+        except Exception as e:
+            error = e
+            if attempt < retries:
+                time.sleep(min(2 ** attempt, 30))
+    return 'failed', error, blob
+
+@timed("copy_to_cloud", job="job_id",
+       measure=lambda summary: {'items': len(summary['uploaded']) + len(summary['repaired']),
+                                'nbytes': summary['bytes'], 'errors': len(summary['failed'])})
+def copy_to_cloud(local_path, cloud_path, service_account_file_path, bucket_name, job_id, storage_client=None, workers=1, retries=3, verify_crc=False, journal=None, manifest=None):
     """
     Copy data from local path to Google Cloud Storage.
     
@@ -173,194 +589,1056 @@ def copy_to_cloud(local_path, cloud_path, service_account_file_path, bucket_name
     cloud_path: The desired path in GCS where data will be stored.
     service_account_file_path: Path to your service account json file.
     bucket_name: Name of the GCS bucket where data will be uploaded.
+    storage_client: shared client for the run, created from the service account file if None.
+    workers: number of uploads kept in flight at once, 1 keeps the old one-by-one behaviour.
+    retries: attempts per file before it is reported as failed.
+    verify_crc: also compare the local CRC32C with the listed one, costs a full read of every file.
+    journal: UploadJournal, files it already lists as uploaded are skipped without any request.
+    manifest: ContentManifest, files whose size and mtime match their entry are skipped without
+              any request, and only files whose stat changed are hashed.
+    return: summary dict with 'uploaded', 'skipped', 'repaired' and 'failed' lists of cloud file paths,
+            'failed' holds (cloud_file_path, error) tuples, 'bytes' the size of the files sent.
     """
     
-    # Check if local path exists
-    storage_client = storage.Client.from_service_account_json(service_account_file_path)
+    if storage_client is None:
+        storage_client = get_storage_client(service_account_file_path)
     bucket = storage_client.bucket(bucket_name)
 
+    summary = {'uploaded': [], 'skipped': [], 'repaired': [], 'failed': [], 'bytes': 0}
+    mismatched = set()
+
+    def record(local_file, cloud_file_path, status, error, blob):
+        if status == 'failed':
+            print(f"Failed to upload {cloud_file_path} for job_id {job_id}: {error}")
+            summary['failed'].append((cloud_file_path, error))
+            return
+        if cloud_file_path in mismatched:
+            summary['repaired'].append(cloud_file_path)
+        else:
+            summary[status].append(cloud_file_path)
+        summary['bytes'] += blob.size or os.path.getsize(local_file)
+        if journal is not None:
+            journal.mark_file(job_id, local_file, cloud_file_path, UPLOADED)
+        if manifest is not None:
+            manifest.record(local_file, blob.crc32c, blob.generation, cloud_file_path)
+
     # Walk through all files in the local directory
+    local_files = []
+    done = journal.done_files(job_id) if journal is not None else set()
     for dirpath, dirnames, filenames in os.walk(local_path):
         for filename in filenames:
             local_file = os.path.join(dirpath, filename)
             # Create the full cloud path for this file
             cloud_file_path = os.path.join(cloud_path, os.path.relpath(local_file, local_path)).replace(os.sep, '/')
-            blob = bucket.blob(cloud_file_path)
-            
-            # Check if the blob exists in GCS
-            if not blob.exists():
-                blob.upload_from_filename(local_file)
-            else:
-                print(f"File {cloud_file_path} already exists in GCS. Skipping upload.")
-
-def uploade96_to_cloud(job_id, local_path, service_account_file_path, bucket_name):
+            if cloud_file_path in done:
+                summary['skipped'].append(cloud_file_path)
+                continue
+            if manifest is not None:
+                entry = manifest.unchanged(local_file)
+                # uploaded before and not touched since, no request needed
+                if entry is not None and entry[3] is not None and entry[4] == cloud_file_path:
+                    summary['skipped'].append(cloud_file_path)
+                    continue
+            local_files.append((local_file, cloud_file_path))
+
+    # One listing of the destination prefix replaces a blob.exists() call per file
+    existing = list_cloud_prefix(bucket, cloud_path) if local_files else {}
+
+    files = []
+    for local_file, cloud_file_path in local_files:
+        state = needs_upload(local_file, cloud_file_path, existing, verify_crc, manifest)
+        if state == 'match':
+            summary['skipped'].append(cloud_file_path)
+            if journal is not None:
+                journal.mark_file(job_id, local_file, cloud_file_path, VERIFIED)
+            if manifest is not None:
+                blob = existing[cloud_file_path]
+                # only cache the checksum if it was actually compared with the local file
+                manifest.record(local_file, blob.crc32c if verify_crc else None, blob.generation, cloud_file_path)
+            continue
+        if state == 'mismatch':
+            print(f"File {cloud_file_path} in GCS does not match the local file. Uploading again.")
+            mismatched.add(cloud_file_path)
+        files.append((local_file, cloud_file_path))
+
+    if summary['skipped']:
+        print(f"{len(summary['skipped'])} files under {cloud_path} already exist in GCS. Skipping upload.")
+
+    if workers <= 1:
+        for local_file, cloud_file_path in files:
+            record(local_file, cloud_file_path, *upload_file(bucket, local_file, cloud_file_path, retries, storage_client))
+    else:
+        # Keep at most 2 * workers uploads queued so a large scan area does not build thousands of futures
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            in_flight = {}
+            for local_file, cloud_file_path in files:
+                if len(in_flight) >= 2 * workers:
+                    finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        record(*in_flight.pop(future), *future.result())
+                future = executor.submit(upload_file, bucket, local_file, cloud_file_path, retries, storage_client)
+                in_flight[future] = (local_file, cloud_file_path)
+            for future in as_completed(in_flight):
+                record(*in_flight[future], *future.result())
+
+    if journal is not None:
+        journal.flush()
+    if manifest is not None:
+        manifest.flush()
+    return summary
+
+def uploade96_to_cloud(job_id, local_path, service_account_file_path, bucket_name, storage_client=None):
     """Uploads the file to GCS based on job_id."""
 
     # Construct the cloud path
     cloud_path = "e96/" + str(job_id) + "/e96_wells"
 
     # Initialize GCS client
-    storage_client = storage.Client.from_service_account_json(service_account_file_path)
+    if storage_client is None:
+        storage_client = get_storage_client(service_account_file_path)
     bucket = storage_client.bucket(bucket_name)
 
-    # Upload the file
-    blob = bucket.blob(cloud_path)
-    blob.upload_from_filename(local_path)
+    # Upload the file, in parallel parts composed into one object when it is large
+    storage_client.upload(bucket, local_path, cloud_path)
 
     print(f"Uploaded {local_path} to {cloud_path}")
 
 
-def upload_data(mysql_connection, mysql_cursor, sqlce_connection, sqlce_cursor, service_account_file_path, bucket_name, data_source, logger):
+def transfer_job(job_id, local_paths, cloud_paths, service_account_file_path, bucket_name, storage_client, logger, workers=1, retries=3, verify_crc=False, journal=None, manifest=None, pack_chunk_bytes=None, preview_factors=()):
+    '''
+    Upload every scan area of a job, its previews and, once everything else succeeded, its e96_wells file.
+    Only touches GCS and local files, the PathStorage rows are returned for the caller to write.
+    return: dict with 'paths' [(local_path, cloud_path, level)] of the data that exists locally
+            (empty if the job has no local data) and 'failed' [(cloud_file_path, error)]
+    '''
+    paths = []
+    failed_files = []
+
+    # If local data exists, copy it to the cloud
+    for local_path, cloud_path in zip(local_paths, cloud_paths):
+        if not os.path.exists(local_path):
+            logger.warning(f"Error: Local path {local_path} does not exist. Skipping.")
+            continue
+        print('Tring to copy:',local_path,'to cloud:',cloud_path)
+        if pack_chunk_bytes:
+            # a few chunk objects plus an index instead of one object per frame
+            try:
+                index, uploaded = upload_pack(storage_client.bucket(bucket_name), local_path, cloud_path, pack_chunk_bytes)
+                frames = list(index['frames'])
+                summary = {'uploaded': frames if uploaded else [], 'skipped': [] if uploaded else frames,
+                           'repaired': [], 'failed': [], 'bytes': 0}
+            except Exception as e:
+                summary = {'uploaded': [], 'skipped': [], 'repaired': [], 'failed': [(pack_prefix(cloud_path), e)], 'bytes': 0}
+        else:
+            summary = copy_to_cloud(local_path, cloud_path, service_account_file_path, bucket_name, job_id,
+                                    storage_client=storage_client, workers=workers, retries=retries, verify_crc=verify_crc,
+                                    journal=journal, manifest=manifest)
+        logger.info(f"Job {job_id} {cloud_path}: {len(summary['uploaded'])} uploaded, "
+                    f"{len(summary['skipped'])} skipped, {len(summary['repaired'])} repaired, "
+                    f"{len(summary['failed'])} failed")
+        failed_files.extend(summary['failed'])
+        paths.append((local_path, cloud_path, 0))
+
+        # downsampled copies under a sibling prefix, so a well can be browsed without the full stack
+        if preview_factors and not summary['failed']:
+            for factor, preview_path in build_previews(local_path, preview_factors).items():
+                preview_summary = copy_to_cloud(preview_path, preview_cloud_path(cloud_path, factor), service_account_file_path, bucket_name, job_id,
+                                                storage_client=storage_client, workers=workers, retries=retries,
+                                                journal=journal, manifest=manifest)
+                failed_files.extend(preview_summary['failed'])
+                paths.append((preview_path, preview_cloud_path(cloud_path, factor), factor))
+
+    if paths and not failed_files:
+        local_path_e96 = f'{job_id}/Acquire_0/e96_wells'
+        cloud_path_e96 = "e96/" + str(job_id) + "/e96_wells"
+        if journal is None or cloud_path_e96 not in journal.done_files(job_id):
+            uploade96_to_cloud(job_id, local_path_e96, service_account_file_path, bucket_name, storage_client=storage_client)
+            if journal is not None:
+                journal.mark_file(job_id, local_path_e96, cloud_path_e96, UPLOADED)
+
+        #upload sdf?
+
+    return {'paths': paths, 'failed': failed_files}
+
+def store_job_paths(mysql_cursor, job_id, paths, journal=None, connection=None):
+    '''
+    Write the PathStorage rows of a job once, the journal remembers jobs whose rows are already there.
+    Paths the job already has are skipped, so a retried or repeated call adds no duplicates.
+    '''
+    if journal is not None and journal.table_state(job_id, "PathStorage") == INSERTED:
+        return
+    mysql_cursor.execute("SELECT cloud_path FROM PathStorage WHERE job_id = %s", (job_id,))
+    stored = {row[0] for row in mysql_cursor.fetchall()}
+    for local_path, cloud_path, level in paths:
+        if cloud_path not in stored:
+            store_paths(mysql_cursor, job_id, local_path, cloud_path, level=level, connection=connection)
+    if journal is not None:
+        journal.mark_table(job_id, "PathStorage", INSERTED)
+
+def write_job_rows(mysql_connection, mysql_cursor, sqlce_cursor, job, job_columns, logger, bundle=None, columns=None, batch_size=None, on_duplicate='ignore', journal=None):
+    '''
+    Insert the Job row and its child tables, from an extracted bundle when there is one.
+    return: True if every row landed
+    '''
+    job_id = job[0]
+    if bundle is not None or batch_size:
+        try:
+            if bundle is not None:
+                counts = insert_bundle_into_mysql(mysql_connection, mysql_cursor, bundle, columns, batch_size or 500, on_duplicate)
+            else:
+                counts = insert_job_into_mysql(mysql_connection, sqlce_cursor, mysql_cursor, job, job_columns, batch_size, on_duplicate)
+            logger.info(f"Inserted job {job_id} in one transaction: {counts}")
+        except mysql.connector.Error as e:
+            if is_transient(e):
+                raise
+            logger.error(f"Error inserting data for Job ID {job_id}, transaction rolled back: {e}")
+            return False
+        if journal is not None:
+            for table in counts:
+                journal.mark_table(job_id, table, INSERTED)
+        return True
 
-    query_job = "SELECT * FROM Job"
-    sqlce_cursor.execute(query_job)
-    results = sqlce_cursor.fetchall()
+    try:
+        if journal is None or journal.table_state(job_id, "Job") != INSERTED:
+            insert_query = f"INSERT INTO Job VALUES ({', '.join(['%s'] * len(job))})"
+            mysql_cursor.execute(insert_query, job)
+            mysql_connection.commit()  # Changed from mysql_connection to mysql_conn
+            if journal is not None:
+                journal.mark_table(job_id, "Job", INSERTED)
+
+        # Use insert_data_into_mysql function for inserting data to tables 
+
+        for table, column in CHILD_TABLES:
+            if journal is not None and journal.table_state(job_id, table) == INSERTED:
+                continue
+            insert_data_into_mysql(sqlce_cursor, mysql_cursor, table, column, job_id, connection=mysql_connection)
+            if journal is not None:
+                journal.mark_table(job_id, table, INSERTED)
+
+    except mysql.connector.IntegrityError as ie:
+        logger.error(f"Error inserting data for Job ID {job_id}: {ie}")
+        return False
+    return True
+
+def write_job_scans(mysql_connection, mysql_cursor, sqlce_cursor, job_id, logger, staging_dir, bundle=None, columns=None, on_duplicate='ignore', batch_size=None, journal=None, mysql_pool=None, staged=None):
+    '''
+    Migrate the Scan rows of a job: stage them from SQLCE into a file, then bulk load it.
+    staged: (staging file, columns, rows) of stage_job_scans when it already ran, e.g. in the extract stage
+    return: True if loaded (or already loaded)
+    '''
+    if journal is not None and journal.table_state(job_id, "Scan") == INSERTED:
+        return True
+    if staged is None:
+        staged = stage_job_scans(sqlce_cursor, job_id, job_scan_area_ids(sqlce_cursor, job_id, bundle, columns), staging_dir)
+    staging_file, scan_columns, count = staged
+    if count:
+        try:
+            loaded = mysql_call(mysql_pool, mysql_connection, mysql_cursor,
+                                lambda connection, cursor: load_scan_file(connection, cursor, staging_file, scan_columns,
+                                                                          on_duplicate, batch_size or 500))
+        except mysql.connector.Error as e:
+            if is_transient(e):
+                raise
+            logger.error(f"Error loading Scan rows for Job ID {job_id}: {e}")
+            return False
+        logger.info(f"Job {job_id}: {count} Scan rows staged, {loaded} loaded")
+    os.remove(staging_file)
+    if journal is not None:
+        journal.mark_table(job_id, "Scan", INSERTED)
+        # an OptimalZLevel marked before these rows existed updated nothing, score the job again
+        if count:
+            journal.mark_table(job_id, "OptimalZLevel", PENDING)
+    return True
+
+def score_job_focus(sqlce_cursor, job_id, focus_workers, bundle=None, columns=None):
+    '''
+    Sharpest z-slice per (ScanArea, RepetitionIndex) of the job's local z-stacks.
+    return: list of (scan_area_id, repetition_index, optimal_z_level)
+    '''
+    scan_areas = [(scan_area_id, local_path) for scan_area_id, local_path in scan_area_paths(sqlce_cursor, job_id, bundle, columns)
+                  if os.path.exists(local_path)]
+    return score_scan_areas(scan_areas, focus_workers)
+
+def write_job_focus(mysql_connection, mysql_cursor, sqlce_cursor, job_id, logger, focus_workers, bundle=None, columns=None, batch_size=None, journal=None, mysql_pool=None, focus_rows=None):
+    '''
+    Score the sharpest z-slice per (ScanArea, RepetitionIndex) and write it into Scan.OptimalZLevel.
+    Only call it once write_job_scans loaded the job's Scan rows, the UPDATE has nothing to change before.
+    A pooled connection is only borrowed for the write, not while the stacks are scored.
+    focus_rows: score_job_focus result when the job was already scored, only the UPDATE is left
+    return: True if stored (or already stored)
+    '''
+    if journal is not None and journal.table_state(job_id, "OptimalZLevel") == INSERTED:
+        return True
+    if focus_rows is None:
+        focus_rows = score_job_focus(sqlce_cursor, job_id, focus_workers, bundle, columns)
+    try:
+        updated = mysql_call(mysql_pool, mysql_connection, mysql_cursor,
+                             lambda connection, cursor: store_optimal_z_levels(connection, cursor, focus_rows, batch_size or 500))
+    except mysql.connector.Error as e:
+        if is_transient(e):
+            raise
+        logger.error(f"Error storing OptimalZLevel for Job ID {job_id}: {e}")
+        return False
+    logger.info(f"Job {job_id}: best z of {len(focus_rows)} repetitions scored, {updated} Scan rows updated")
+    if journal is not None:
+        journal.mark_table(job_id, "OptimalZLevel", INSERTED)
+    return True
+
+def mysql_call(mysql_pool, mysql_connection, mysql_cursor, func):
+    '''
+    Run func(connection, cursor) on a pooled connection, retried on a fresh one after transient errors,
+    or on the single connection of the run after checking it is still alive.
+    '''
+    if mysql_pool is not None:
+        return mysql_pool.run(func)
+    ensure_connected(mysql_connection)
+    return func(mysql_connection, mysql_cursor)
+
+def upload_data(mysql_connection, mysql_cursor, sqlce_connection, sqlce_cursor, service_account_file_path, bucket_name, data_source, logger, workers=1, retries=3, verify_crc=False, batch_size=None, on_duplicate='ignore', bulk_extract=False, journal=None, manifest=None, pack_chunk_bytes=None, preview_factors=(), focus_workers=0, shard=None, progress_file='last_uploaded.txt', mysql_pool=None, scan_staging_dir=None, storage_client=None):
+    '''
+    Migrate every job above the high-water mark: upload its files, then copy its rows to MySQL.
+    shard: only migrate the jobs of this shard, see job_in_shard
+    progress_file: last_uploaded.txt replacement, used when there is no journal
+    mysql_pool: MySQLPool the writes borrow their connection from, mysql_connection is used if None.
+                The jobs are written one after the other, so only one connection is borrowed at a time,
+                the pool gives the writes a health check and retries on transient errors, not concurrency.
+    scan_staging_dir: folder for the staged Scan files, None skips the Scan table
+    storage_client: storage backend the files go to, GCS from the service account file if None
+    return: report with the 'inserted', 'uploaded' and 'empty' job ids and 'failed' job id -> [error]
+    '''
+    report = {'inserted': [], 'uploaded': [], 'empty': [], 'failed': {}}
+    if focus_workers and not scan_staging_dir:
+        logger.warning("OptimalZLevel is not scored, it is written into the Scan rows that scan_staging_dir loads")
+
+    # one GCS client for the whole run, shared by every upload thread
+    if storage_client is None:
+        storage_client = get_storage_client(service_account_file_path)
 
     # skip the last job, save time
-    last_uploaded_id = get_last_uploaded_job_id()
+    if journal is not None:
+        last_uploaded_id = journal.high_water_mark()
+    else:
+        last_uploaded_id = get_last_uploaded_job_id(progress_file)
+    if shard is not None and shard.get('range'):
+        last_uploaded_id = max(last_uploaded_id, shard['range'][0] - 1)
+
+    bundles = {}
+    columns = None
+    job_columns = None
+    if bulk_extract:
+        # a handful of table scans instead of several queries per job
+        bundles, columns = extract_job_bundles(sqlce_cursor, last_uploaded_id, shard=shard)
+        results = [bundle['job'] for bundle in bundles.values()]
+        logger.info(f"Extracted {len(bundles)} jobs from {data_source}")
+    else:
+        query_job = "SELECT * FROM Job ORDER BY Id"
+        sqlce_cursor.execute(query_job)
+        results = sqlce_cursor.fetchall()
+        job_columns = [description[0] for description in sqlce_cursor.description]
+
     for job in results:
         job = list(job)  # job[0] is Job_id
         job_id = job[0]
 
         if job_id <= last_uploaded_id:
             continue
+        if shard is not None and not job_in_shard(job_id, shard):
+            continue
 
-        local_paths, cloud_paths = generate_paths(sqlce_cursor, job_id, job[1])
+        if journal is not None:
+            if journal.job_state(job_id) in (INSERTED, EMPTY):
+                continue
+            journal.mark_job(job_id, PENDING)
 
-        files_exist = False 
-        
-        
+        bundle = bundles.get(job_id)
+        if bundle is not None:
+            local_paths, cloud_paths = bundle['local_paths'], bundle['cloud_paths']
+        else:
+            local_paths, cloud_paths = generate_paths(sqlce_cursor, job_id, job[1])
 
-        # If local data exists, copy it to the cloud
-        for local_path, cloud_path in zip(local_paths, cloud_paths):
-            if not os.path.exists(local_path):
-                logger.warning(f"Error: Local path {local_path} does not exist. Skipping.")
-                continue
-            print('Tring to copy:',local_path,'to cloud:',cloud_path)
-            copy_to_cloud(local_path, cloud_path, service_account_file_path, bucket_name, job_id)
-            store_paths(mysql_cursor, job_id, local_path, cloud_path) 
-            files_exist = True
+        transfer = transfer_job(job_id, local_paths, cloud_paths, service_account_file_path, bucket_name, storage_client, logger,
+                                workers=workers, retries=retries, verify_crc=verify_crc, journal=journal, manifest=manifest,
+                                pack_chunk_bytes=pack_chunk_bytes, preview_factors=preview_factors)
 
-        if not files_exist:
+        if not transfer['paths']:
+            if journal is not None:
+                journal.mark_job(job_id, EMPTY)
+            report['empty'].append(job_id)
             continue
-        
-        local_path_e96 = f'{job_id}/Acquire_0/e96_wells'
-        uploade96_to_cloud(job_id, local_path_e96, service_account_file_path, bucket_name)
 
-        #upload sdf?
+        mysql_call(mysql_pool, mysql_connection, mysql_cursor,
+                   lambda connection, cursor: store_job_paths(cursor, job_id, transfer['paths'], journal, connection))
+
+        # leave the job unmarked so the next run retries only the missing files,
+        # without a journal the high-water mark stops below it for the rest of the run
+        if transfer['failed']:
+            for cloud_file_path, error in transfer['failed']:
+                logger.error(f"Upload failed for {cloud_file_path}: {error}")
+            logger.error(f"Job {job_id} has {len(transfer['failed'])} failed files, not marking it as uploaded.")
+            report['failed'][job_id] = [f"{cloud_file_path}: {error}" for cloud_file_path, error in transfer['failed']]
+            continue
 
         #update the finished job uploading task
-        update_last_uploaded_job_id(job_id, filename='last_uploaded.txt')
-        
+        if journal is not None:
+            journal.mark_job(job_id, UPLOADED)
+        report['uploaded'].append(job_id)
+
+        if not mysql_call(mysql_pool, mysql_connection, mysql_cursor,
+                          lambda connection, cursor: write_job_rows(connection, cursor, sqlce_cursor, job, job_columns, logger,
+                                                                    bundle, columns, batch_size, on_duplicate, journal)):
+            report['failed'][job_id] = ["rows not inserted"]
+            continue
+
+        # Scan rows in bulk, before the focus step updates their OptimalZLevel
+        if scan_staging_dir and not write_job_scans(mysql_connection, mysql_cursor, sqlce_cursor, job_id, logger, scan_staging_dir,
+                                                    bundle, columns, on_duplicate, batch_size, journal, mysql_pool):
+            report['failed'][job_id] = ["Scan rows not loaded"]
+            continue
+
+        # sharpest z-slice per (ScanArea, RepetitionIndex) into Scan.OptimalZLevel
+        if focus_workers and scan_staging_dir and not write_job_focus(mysql_connection, mysql_cursor, sqlce_cursor, job_id, logger, focus_workers,
+                                                 bundle, columns, batch_size, journal, mysql_pool):
+            report['failed'][job_id] = ["OptimalZLevel not stored"]
+            continue
+
+        if journal is not None:
+            journal.mark_job(job_id, INSERTED)
+        else:
+            advance_last_uploaded_job_id(job_id, report['failed'], filename=progress_file)
+        report['inserted'].append(job_id)
+
+    return report
+
+def job_in_shard(job_id, shard):
+    '''
+    shard: dict with 'index', 'count' and either 'range' (first id, last id) or nothing for modulo,
+           a last id of None leaves the range open for jobs acquired later
+    '''
+    if shard.get('range'):
+        first_id, last_id = shard['range']
+        return first_id <= job_id and (last_id is None or job_id <= last_id)
+    return job_id % shard['count'] == shard['index']
 
+def shard_condition(column, shard):
+    '''
+    SQL condition on a job id column with its parameters, the upper end of job_in_shard.
+    The lower end of a range is applied through last_uploaded_id.
+    '''
+    if shard is None:
+        return "", ()
+    if shard.get('range'):
+        last_id = shard['range'][1]
+        return ("", ()) if last_id is None else (f" AND {column} <= ?", (last_id,))
+    return f" AND {column} % {int(shard['count'])} = {int(shard['index'])}", ()
+
+def plan_shards(sqlce_cursor, count, partition='range', last_uploaded_id=0):
+    '''
+    Split the jobs above last_uploaded_id into count shards.
+    'range' gives every shard a contiguous block with the same number of jobs, the last block
+    is open ended so jobs acquired later stay in one shard,
+    'modulo' spreads them by job_id % count, which also balances jobs acquired later.
+    '''
+    if partition == 'modulo':
+        return [{'index': index, 'count': count} for index in range(count)]
+    if partition != 'range':
+        raise ValueError(f"Unknown shard partition {partition}")
+
+    sqlce_cursor.execute("SELECT Id FROM Job WHERE Id > ? ORDER BY Id", (last_uploaded_id,))
+    job_ids = [row[0] for row in sqlce_cursor.fetchall()]
+    shards = []
+    for index in range(count):
+        block = job_ids[len(job_ids) * index // count:len(job_ids) * (index + 1) // count]
+        if block:
+            shards.append({'index': index, 'count': count, 'range': [block[0], block[-1]]})
+    if shards:
+        shards[-1]['range'][1] = None
+    return shards
+
+def load_shard_plan(sqlce_cursor, count, partition='range', plan_file="shard_plan.json", last_uploaded_id=0):
+    '''
+    Shards of the previous run if they were planned with the same count and partition, otherwise
+    a new plan of the jobs above last_uploaded_id that is saved to plan_file. Range boundaries must
+    not move between runs, every shard only knows the jobs its own journal has seen.
+    A plan without shards is not saved, the next run plans again once there are jobs.
+    '''
+    if plan_file and os.path.exists(plan_file):
+        with open(plan_file) as f:
+            plan = json.load(f)
+        if plan['count'] == count and plan['partition'] == partition:
+            return plan['shards']
+    shards = plan_shards(sqlce_cursor, count, partition, last_uploaded_id)
+    if plan_file and shards:
+        with open(plan_file, 'w') as f:
+            json.dump({'count': count, 'partition': partition, 'shards': shards}, f, indent=4)
+    return shards
+
+def shard_file(filename, index):
+    '''
+    upload_journal.db -> upload_journal.shard0.db, so every shard keeps its own progress
+    '''
+    if not filename:
+        return filename
+    root, extension = os.path.splitext(filename)
+    return f"{root}.shard{index}{extension}"
+
+def shard_high_water_mark(config, index):
+    '''
+    Highest job id below which shard index has finished all of its jobs, from its journal
+    or its last_uploaded file.
+    '''
+    journal_file = shard_file(config.get("journal_file"), index)
+    if journal_file and os.path.exists(journal_file):
+        journal = UploadJournal(journal_file)
         try:
-            insert_query = f"INSERT INTO Job VALUES ({', '.join(['%s'] * len(job))})"
-            mysql_cursor.execute(insert_query, job)
-            mysql_connection.commit()  # Changed from mysql_connection to mysql_conn
+            return journal.high_water_mark()
+        finally:
+            journal.close()
+    return get_last_uploaded_job_id(shard_file("last_uploaded.txt", index))
 
-            # Use insert_data_into_mysql function for inserting data to tables 
+def merge_high_water_marks(shards, marks, last_uploaded_id=0):
+    '''
+    Highest job id below which every shard has finished, the progress of the whole sharded upload.
+    marks: shard_high_water_mark of every shard, in the order of shards
+    '''
+    if not shards:
+        return last_uploaded_id
+    if not shards[0].get('range'):
+        # every shard holds every count-th job, a job is only done below the slowest shard
+        return max(last_uploaded_id, min(marks))
+    mark = last_uploaded_id
+    for shard, shard_mark in sorted(zip(shards, marks), key=lambda item: item[0]['range'][0]):
+        first_id, last_id = shard['range']
+        # the jobs before a range are the earlier shards, or finished before the plan was made
+        mark = max(mark, shard_mark, first_id - 1)
+        if last_id is None or mark < last_id:
+            break
+    return mark
+
+def upload_options(config):
+    '''
+    upload_data keyword arguments from config.json
+    '''
+    return {
+        'workers': config.get("upload_workers", 8),
+        'retries': config.get("upload_retries", 3),
+        'verify_crc': config.get("upload_verify_crc", False),
+        'batch_size': config.get("insert_batch_size", 500),
+        'on_duplicate': config.get("insert_on_duplicate", "ignore"),
+        'bulk_extract': config.get("bulk_extract", True),
+        'pack_chunk_bytes': config.get("pack_chunk_mb", 0) * 1024 * 1024,
+        'preview_factors': config.get("preview_factors", []),
+        'focus_workers': config.get("focus_workers", 0),
+        'scan_staging_dir': config.get("scan_staging_dir"),
+    }
+
+def run_shard(config, shard, last_uploaded_id=0):
+    '''
+    Worker process of a sharded upload, with its own connections, GCS client, journal, manifest and log.
+    last_uploaded_id: progress of the whole upload, the shard's journal and last_uploaded file start from it
+    return: upload_data report of the shard, errors as strings so it can be pickled back
+    '''
+    global mysql_connection
+    index = shard['index']
+    logger = setup_logger(shard_file("migration_log.txt", index))
+    # a forked shard inherits the parent's counters and export state
+    METRICS.reset()
+    METRICS.start_export(shard_file(config.get("prometheus_file"), index), config.get("metrics_interval", 15))
+    progress_file = shard_file("last_uploaded.txt", index)
+    if get_last_uploaded_job_id(progress_file) < last_uploaded_id:
+        update_last_uploaded_job_id(last_uploaded_id, progress_file)
+    journal = open_journal(shard_file(config.get("journal_file"), index), progress_file, last_uploaded_id)
+    manifest = open_manifest(shard_file(config.get("manifest_file"), index))
+    mysql_connection = sqlce_connection = storage_client = None
+    try:
+        mysql_connection, mysql_cursor = connect_to_mysql(config["db_host"], config["db_name"], config["db_user"], config["db_password"],
+                                                          config.get("scan_staging_dir"))
+        sqlce_connection, sqlce_cursor = connect_to_sqlce(config["data_source"])
+        mysql_pool = connect_pool(config["db_host"], config["db_name"], config["db_user"], config["db_password"],
+                                  config.get("mysql_pool_size", 0), config.get("mysql_retries", 3), config.get("scan_staging_dir"))
+        storage_client = storage_from_config(config)
+        logger.info(f"Shard {index}/{shard['count']} started: {shard.get('range', 'modulo')}")
+        report = upload_data(mysql_connection, mysql_cursor, sqlce_connection, sqlce_cursor,
+                             config["service_account_file_path"], config["bucket_name"], config["data_source"], logger,
+                             journal=journal, manifest=manifest, shard=shard, mysql_pool=mysql_pool, storage_client=storage_client,
+                             progress_file=progress_file, **upload_options(config))
+    except Exception as e:
+        logger.error(f"Shard {index} stopped: {e}")
+        report = {'inserted': [], 'uploaded': [], 'empty': [], 'failed': {}, 'error': str(e)}
+    finally:
+        if sqlce_connection is not None:
+            sqlce_connection.close()
+        if mysql_connection is not None:
+            mysql_connection.close()
+        if storage_client is not None:
+            storage_client.close()
+        if journal is not None:
+            journal.close()
+        if manifest is not None:
+            manifest.close()
+        METRICS.stop_export()
+        if config.get("metrics_file"):
+            METRICS.write_json(shard_file(config["metrics_file"], index))
+    report['shard'] = index
+    return report
+
+def upload_sharded(config, sqlce_cursor, logger, count, partition='range', report_file="shard_report.json", plan_file="shard_plan.json", journal=None, progress_file='last_uploaded.txt'):
+    '''
+    Run the upload in count worker processes, one shard of the job ids each, and merge their reports.
+    Every shard writes to its own journal, manifest, log and last_uploaded file.
+    plan_file: shards of the first run, reused as long as count and partition stay the same
+    journal, progress_file: progress of the single process upload, the shards start from it and the
+    jobs all shards have finished are written back into it, so the upload can switch between modes
+    return: merged report, also written to report_file
+    '''
+    if journal is not None:
+        last_uploaded_id = journal.high_water_mark()
+    else:
+        last_uploaded_id = get_last_uploaded_job_id(progress_file)
+    shards = load_shard_plan(sqlce_cursor, count, partition, plan_file, last_uploaded_id)
+    merged = {'inserted': [], 'uploaded': [], 'empty': [], 'failed': {}, 'shards': []}
+    with ProcessPoolExecutor(max_workers=len(shards) or 1) as executor:
+        futures = {executor.submit(run_shard, config, shard, last_uploaded_id): shard for shard in shards}
+        for future in as_completed(futures):
+            shard = futures[future]
+            try:
+                report = future.result()
+            except Exception as e:
+                report = {'inserted': [], 'uploaded': [], 'empty': [], 'failed': {}, 'error': str(e), 'shard': shard['index']}
+            for key in ('inserted', 'uploaded', 'empty'):
+                merged[key].extend(report[key])
+            merged['failed'].update(report['failed'])
+            merged['shards'].append({'shard': report['shard'], 'range': shard.get('range'),
+                                     'inserted': len(report['inserted']), 'failed': len(report['failed']),
+                                     'error': report.get('error')})
+            logger.info(f"Shard {report['shard']} finished: {len(report['inserted'])} jobs inserted, "
+                        f"{len(report['failed'])} failed{', error: ' + report['error'] if report.get('error') else ''}")
+
+    for key in ('inserted', 'uploaded', 'empty'):
+        merged[key].sort()
+    merged['shards'].sort(key=lambda shard: shard['shard'])
+
+    marks = [shard_high_water_mark(config, shard['index']) for shard in shards]
+    merged['last_uploaded_id'] = merge_high_water_marks(shards, marks, last_uploaded_id)
+    if merged['last_uploaded_id'] > last_uploaded_id:
+        if journal is not None:
+            journal.seed(merged['last_uploaded_id'])
+        else:
+            update_last_uploaded_job_id(merged['last_uploaded_id'], progress_file)
+    for job_id, errors in sorted(merged['failed'].items()):
+        logger.error(f"Job {job_id} failed: {errors}")
+    if report_file:
+        with open(report_file, 'w') as f:
+            json.dump(merged, f, indent=4)
+    return merged
 
-            insert_data_into_mysql(sqlce_cursor, mysql_cursor, "JobTask", "Job_id", job_id)
-            insert_data_into_mysql(sqlce_cursor, mysql_cursor, "JobEvent", "Job_id", job_id)
-            insert_data_into_mysql(sqlce_cursor, mysql_cursor, "AcquireTask", "JobTask_id", job_id)
-            insert_data_into_mysql(sqlce_cursor, mysql_cursor, "AcquireSettings", "OriginalAcquireTask_id", job_id)
-            insert_data_into_mysql(sqlce_cursor, mysql_cursor, "InstrumentInformation", "Id", job_id)
-            insert_data_into_mysql(sqlce_cursor, mysql_cursor, "ScanArea", "AcquireSettings_id", job_id)
-            
-            #ToDo
-            #add insert data to scan table
 
-        except mysql.connector.IntegrityError as ie:
-            logger.error(f"Error inserting data for Job ID {job_id}: {ie}")
-            continue
+async def upload_data_pipelined(mysql_connection, mysql_cursor, sqlce_connection, sqlce_cursor, service_account_file_path, bucket_name, data_source, logger, workers=1, retries=3, verify_crc=False, batch_size=None, on_duplicate='ignore', journal=None, manifest=None, pack_chunk_bytes=None, preview_factors=(), focus_workers=0, queue_size=2, extract_jobs=20, mysql_pool=None, scan_staging_dir=None, storage_client=None):
+    '''
+    Same migration as upload_data, but SQLCE reads, GCS transfers and MySQL writes run as three
+    concurrent stages connected by bounded queues, so while one job uploads the next one is
+    being extracted and the previous one written.
+
+    Every blocking call runs in an executor with a single thread per resource, so the adodbapi
+    and mysql.connector connections are still only used from one thread each. OptimalZLevel is
+    scored in its own executor while the job transfers, the write stage only stores it.
+    queue_size: jobs allowed to wait between two stages, a full queue blocks the stage before it
+    extract_jobs: jobs read from SQLCE per extraction round, bounds the rows held in memory
+    A job that fails in any stage is logged and reported, the pipeline goes on with the next one.
+    return: report like upload_data
+    '''
+    report = {'inserted': [], 'uploaded': [], 'empty': [], 'failed': {}}
+    if focus_workers and not scan_staging_dir:
+        logger.warning("OptimalZLevel is not scored, it is written into the Scan rows that scan_staging_dir loads")
+    loop = asyncio.get_running_loop()
+    sqlce_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlce')
+    gcs_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='gcs')
+    mysql_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='mysql')
+    focus_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='focus')
+    to_transfer = asyncio.Queue(maxsize=queue_size)
+    to_write = asyncio.Queue(maxsize=queue_size)
+    done = object()
+
+    if storage_client is None:
+        storage_client = get_storage_client(service_account_file_path)
+
+    if journal is not None:
+        last_uploaded_id = journal.high_water_mark()
+    else:
+        last_uploaded_id = get_last_uploaded_job_id()
+
+    async def extract():
+        last_id = last_uploaded_id
+        while True:
+            bundles, columns = await loop.run_in_executor(sqlce_executor, extract_job_bundles, sqlce_cursor, last_id, extract_jobs)
+            if not bundles:
+                break
+            logger.info(f"Extracted jobs {min(bundles)}-{max(bundles)} from {data_source}")
+            for job_id, bundle in bundles.items():
+                last_id = job_id
+                if journal is not None and journal.job_state(job_id) in (INSERTED, EMPTY):
+                    continue
+                if scan_staging_dir and (journal is None or journal.table_state(job_id, "Scan") != INSERTED):
+                    # Scan rows are read here, the write stage must not touch the SQLCE connection
+                    try:
+                        scan_area_ids = job_scan_area_ids(None, job_id, bundle, columns)
+                        bundle['scan'] = await loop.run_in_executor(sqlce_executor, stage_job_scans, sqlce_cursor, job_id,
+                                                                    scan_area_ids, scan_staging_dir)
+                    except Exception as e:
+                        logger.error(f"Staging the Scan rows of job {job_id} failed: {e}")
+                        report['failed'][job_id] = [f"Scan rows not staged: {e}"]
+                        continue
+                await to_transfer.put((bundle, columns))
+        # only on a normal exit, a failed stage cancels the others instead
+        await to_transfer.put(done)
+
+    async def score(job_id, bundle, columns):
+        if not (focus_workers and scan_staging_dir):
+            return None
+        if journal is not None and journal.table_state(job_id, "OptimalZLevel") == INSERTED:
+            return None
+        return await loop.run_in_executor(focus_executor, score_job_focus, None, job_id, focus_workers, bundle, columns)
+
+    async def transfer():
+        while (item := await to_transfer.get()) is not done:
+            bundle, columns = item
+            job_id = bundle['job'][0]
+            if journal is not None:
+                journal.mark_job(job_id, PENDING)
+            try:
+                result, bundle['focus'] = await asyncio.gather(loop.run_in_executor(gcs_executor, lambda: transfer_job(
+                    job_id, bundle['local_paths'], bundle['cloud_paths'], service_account_file_path, bucket_name, storage_client, logger,
+                    workers=workers, retries=retries, verify_crc=verify_crc, journal=journal, manifest=manifest,
+                    pack_chunk_bytes=pack_chunk_bytes, preview_factors=preview_factors)), score(job_id, bundle, columns))
+            except Exception as e:
+                logger.error(f"Transfer of job {job_id} failed: {e}")
+                report['failed'][job_id] = [str(e)]
+                continue
+            await to_write.put((bundle, columns, result))
+        await to_write.put(done)
+
+    def write(bundle, columns, result):
+        job = bundle['job']
+        job_id = job[0]
+        if not result['paths']:
+            if journal is not None:
+                journal.mark_job(job_id, EMPTY)
+            report['empty'].append(job_id)
+            return
+        mysql_call(mysql_pool, mysql_connection, mysql_cursor,
+                   lambda connection, cursor: store_job_paths(cursor, job_id, result['paths'], journal, connection))
+        if result['failed']:
+            for cloud_file_path, error in result['failed']:
+                logger.error(f"Upload failed for {cloud_file_path}: {error}")
+            logger.error(f"Job {job_id} has {len(result['failed'])} failed files, not marking it as uploaded.")
+            report['failed'][job_id] = [f"{cloud_file_path}: {error}" for cloud_file_path, error in result['failed']]
+            return
+        if journal is not None:
+            journal.mark_job(job_id, UPLOADED)
+        report['uploaded'].append(job_id)
+        if not mysql_call(mysql_pool, mysql_connection, mysql_cursor,
+                          lambda connection, cursor: write_job_rows(connection, cursor, sqlce_cursor, job, None, logger,
+                                                                    bundle, columns, batch_size, on_duplicate, journal)):
+            report['failed'][job_id] = ["rows not inserted"]
+            return
+        if scan_staging_dir and not write_job_scans(mysql_connection, mysql_cursor, sqlce_cursor, job_id, logger, scan_staging_dir,
+                                                    bundle, columns, on_duplicate, batch_size, journal, mysql_pool,
+                                                    staged=bundle.get('scan')):
+            report['failed'][job_id] = ["Scan rows not loaded"]
+            return
+        if focus_workers and scan_staging_dir and not write_job_focus(mysql_connection, mysql_cursor, sqlce_cursor, job_id, logger, focus_workers,
+                                                 bundle, columns, batch_size, journal, mysql_pool,
+                                                 focus_rows=bundle.get('focus')):
+            report['failed'][job_id] = ["OptimalZLevel not stored"]
+            return
+        if journal is not None:
+            journal.mark_job(job_id, INSERTED)
+        else:
+            # jobs reach this stage in id order, the mark stops below any job that failed before it
+            advance_last_uploaded_job_id(job_id, report['failed'])
+        report['inserted'].append(job_id)
+
+    async def write_rows():
+        while (item := await to_write.get()) is not done:
+            try:
+                await loop.run_in_executor(mysql_executor, write, *item)
+            except Exception as e:
+                job_id = item[0]['job'][0]
+                logger.error(f"Writing job {job_id} failed: {e}")
+                report['failed'][job_id] = [str(e)]
+
+    # an error outside a single job stops the run, the other stages are cancelled
+    # rather than left waiting on a queue nobody reads any more
+    tasks = [asyncio.ensure_future(stage) for stage in (extract(), transfer(), write_rows())]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        for executor in (sqlce_executor, gcs_executor, mysql_executor, focus_executor):
+            executor.shutdown(wait=True)
+    return report
 
 
 
-def download_from_cloud(job_id, service_account_file_path, bucket_name, mysql_cursor, logger):
+def local_file_matches(local_file_path, blob, verify_crc=True, manifest=None):
+    '''
+    True if the local file is a complete copy of the blob.
+    size and crc32c come with the list_blobs result, so this needs no extra request.
+    manifest: ContentManifest, a file whose stat matches an entry for the same generation
+              or crc32c is trusted without hashing it.
+    '''
+    if not os.path.exists(local_file_path):
+        return False
+    if manifest is not None:
+        entry = manifest.unchanged(local_file_path)
+        if entry is not None and (entry[3] == blob.generation or (entry[2] and entry[2] == blob.crc32c)):
+            return True
+    if os.path.getsize(local_file_path) != blob.size:
+        return False
+    if verify_crc and blob.crc32c:
+        local_crc32c = manifest.crc32c(local_file_path) if manifest is not None else file_crc32c(local_file_path)
+        if local_crc32c != blob.crc32c:
+            return False
+    if manifest is not None:
+        manifest.record(local_file_path, blob.crc32c if verify_crc else None, blob.generation, blob.name)
+    return True
+
+def download_blob(blob, local_file_path, retries=3, storage_client=None):
+    '''
+    Download a blob to a temporary file next to the target and rename it into place,
+    so an interrupted download never leaves a partial image under the real name.
+    storage_client: backend the file goes through, so large files are fetched in parallel ranges
+    return: (status, error) where status is 'downloaded' or 'failed'
+    '''
+    tmp_path = local_file_path + '.part'
+    error = None
+    for attempt in range(1, retries + 1):
+        try:
+            if storage_client is not None:
+                storage_client.download(blob, tmp_path)
+            else:
+                blob.download_to_filename(tmp_path)
+            os.replace(tmp_path, local_file_path)
+            return 'downloaded', None
+        except Exception as e:
+            error = e
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            if attempt < retries:
+                time.sleep(min(2 ** attempt, 30))
+    return 'failed', error
+
+@timed("download_from_cloud", job="job_id",
+       measure=lambda summary: {'items': len(summary['downloaded']), 'nbytes': summary['bytes'], 'errors': len(summary['failed'])})
+def download_from_cloud(job_id, service_account_file_path, bucket_name, mysql_cursor, logger, storage_client=None, workers=1, retries=3, verify_crc=True, manifest=None, level=0, replica=None):
     """
     Download entire job data from GCS to local path based on job_id.
 
     job_id: The ID for which data needs to be downloaded.
     service_account_file_path: Path to GCS service account json file.
     bucket_name: Name of the GCS bucket from which data will be downloaded.
-    mysql_cursor: Cursor to the MySQL database to query PathStorage table.
+    mysql_cursor: Cursor to the MySQL database to query PathStorage table, None to only use the replica.
+    storage_client: shared client for the run, created from the service account file if None.
+    workers: number of downloads kept in flight at once.
+    retries: attempts per file before it is reported as failed.
+    verify_crc: compare the crc32c of existing local files with the blob before skipping them,
+                otherwise only the size is compared.
+    manifest: ContentManifest shared with the uploader, files it knows are current are not hashed.
+    level: 0 for the full resolution data, or the factor of a preview level recorded in PathStorage.
+    replica: MetadataReplica the paths are looked up in first, Cloud SQL is only asked if it has none.
+    return: summary dict with 'downloaded', 'skipped' and 'failed' lists of local paths,
+            'failed' holds (local_file_path, error) tuples, 'bytes' the size of the files received.
     """
     
     # Query the PathStorage table to get cloud paths and their corresponding local paths for the given job_id
-    query = "SELECT cloud_path, local_path FROM PathStorage WHERE job_id = %s"
-    mysql_cursor.execute(query, (job_id,))
-    paths = mysql_cursor.fetchall()
+    paths = replica.job_paths(job_id, level) if replica is not None else []
+    if not paths and mysql_cursor is not None:
+        query = "SELECT cloud_path, local_path FROM PathStorage WHERE job_id = %s AND level = %s"
+        mysql_cursor.execute(query, (job_id, level))
+        paths = mysql_cursor.fetchall()
 
     # Initialize GCS client
-    storage_client = storage.Client.from_service_account_json(service_account_file_path)
+    if storage_client is None:
+        storage_client = get_storage_client(service_account_file_path)
     bucket = storage_client.bucket(bucket_name)
 
+    summary = {'downloaded': [], 'skipped': [], 'failed': [], 'bytes': 0}
+    files = []
+    directories = set()
+
     for cloud_path, local_root_path in paths:
-        # List all blobs with the prefix of cloud_path
-        cloud_path = cloud_path.replace('\\', '/')
-        blobs = list(bucket.list_blobs(prefix=cloud_path))
+        # List all blobs under cloud_path, the trailing / keeps the sibling <cloud_path>_preview out
+        cloud_path = cloud_path.replace('\\', '/').rstrip('/')
+        blobs = list(bucket.list_blobs(prefix=cloud_path + '/'))
+
+        # packed scan areas are restored chunk by chunk from their index
+        if any(blob.name == index_name(cloud_path) for blob in blobs):
+            try:
+                written = download_pack(bucket, cloud_path, local_root_path)
+                summary['downloaded'].extend(written)
+            except Exception as e:
+                logger.error(f"Failed to download pack {pack_prefix(cloud_path)}: {e}")
+                summary['failed'].append((local_root_path, e))
+            blobs = [blob for blob in blobs if not blob.name.startswith(pack_prefix(cloud_path) + '/')]
+
         for blob in blobs:
         # Reconstruct the local path based on the blob's name (cloud path) and the local root path
             relative_path_from_cloud_root = os.path.relpath(blob.name, cloud_path)
             local_file_path = os.path.join(local_root_path, relative_path_from_cloud_root)
             
-            # Ensure the directory structure is present
-            os.makedirs(os.path.dirname(local_file_path), exist_ok=True)
-            # print("downloading to:", local_file_path)
-            # Download the blob to the local file path
-            if not os.path.exists(local_file_path):
-                blob.download_to_filename(local_file_path)
-            else:
-                logger.info(f"File {local_file_path} already exists. Skipping download.")
+            if local_file_matches(local_file_path, blob, verify_crc, manifest):
+                summary['skipped'].append(local_file_path)
+                continue
+            directories.add(os.path.dirname(local_file_path))
+            files.append((blob, local_file_path))
+
+    if summary['skipped']:
+        logger.info(f"{len(summary['skipped'])} files of job_id {job_id} already exist. Skipping download.")
 
+    # Ensure the directory structure is present, once per directory
+    for directory in directories:
+        os.makedirs(directory, exist_ok=True)
+
+    def record(blob, local_file_path, status, error):
+        if status == 'failed':
+            logger.error(f"Failed to download {local_file_path}: {error}")
+            summary['failed'].append((local_file_path, error))
+        else:
+            summary[status].append(local_file_path)
+            summary['bytes'] += blob.size or 0
+            if manifest is not None:
+                manifest.record(local_file_path, blob.crc32c, blob.generation, blob.name)
+
+    if workers <= 1:
+        for blob, local_file_path in files:
+            record(blob, local_file_path, *download_blob(blob, local_file_path, retries, storage_client))
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            in_flight = {}
+            for blob, local_file_path in files:
+                if len(in_flight) >= 2 * workers:
+                    finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        record(*in_flight.pop(future), *future.result())
+                future = executor.submit(download_blob, blob, local_file_path, retries, storage_client)
+                in_flight[future] = (blob, local_file_path)
+            for future in as_completed(in_flight):
+                record(*in_flight[future], *future.result())
+
+    if manifest is not None:
+        manifest.flush()
 
     # Notify user of completion
-    messagebox.showinfo("Success", f"Data for job_id {job_id} downloaded successfully!")
+    if summary['failed']:
+        messagebox.showwarning("Incomplete", f"{len(summary['failed'])} files for job_id {job_id} failed to download, run the download again to retry them.")
+    else:
+        messagebox.showinfo("Success", f"Data for job_id {job_id} downloaded successfully!")
+    return summary
 
 
-def downloade96_from_cloud(job_id, download_path, service_account_file_path, bucket_name):
+def downloade96_from_cloud(job_id, download_path, service_account_file_path, bucket_name, storage_client=None):
     """Downloads the file from GCS based on job_id."""
 
     # Construct the cloud path
     cloud_path = "e96/" + str(job_id) + "/e96_wells"
 
     # Initialize GCS client
-    storage_client = storage.Client.from_service_account_json(service_account_file_path)
+    if storage_client is None:
+        storage_client = get_storage_client(service_account_file_path)
     bucket = storage_client.bucket(bucket_name)
 
-    # Download the file
-    blob = bucket.blob(cloud_path)
-    blob.download_to_filename(download_path)  
-
-def download_data(mysql_connection, mysql_cursor, service_account_file_path, bucket_name, logger):
+    # Download the file, in parallel ranges when it is large
+    _, error = download_blob(bucket.blob(cloud_path), download_path, retries=1, storage_client=storage_client)
+    if error is not None:
+        raise error
 
-    def fetch_filtered_data(search_term=""):
-        """Fetches data filtered by the search term."""
-        if search_term:
-            query = "SELECT id, Name FROM Job WHERE Name LIKE %s"
-            mysql_cursor.execute(query, (f"%{search_term}%",))
+def search_jobs(mysql_cursor, search_term="", after_id=0, limit=100, mode='prefix'):
+    '''
+    One page of (Id, Name) of the jobs matching search_term, ordered by Id.
+    Pages are keyset-paginated: pass the last Id of a page as after_id to get the next one,
+    so every page costs the same no matter how deep the list is scrolled.
+    mode: 'prefix'   Name LIKE 'term%', served by the IX_Job_Name index
+          'fulltext' words of the term matched as prefixes by the FT_Job_Name FULLTEXT index
+          'contains' Name LIKE '%term%', the old unindexed substring search
+    '''
+    if not search_term:
+        mysql_cursor.execute("SELECT Id, Name FROM Job WHERE Id > %s ORDER BY Id LIMIT %s", (after_id, limit))
+    elif mode == 'fulltext':
+        # boolean mode: every word required, each one as a prefix; operator characters are dropped
+        words = fulltext_words(search_term)
+        against = ' '.join(f"+{word}*" for word in words)
+        mysql_cursor.execute("SELECT Id, Name FROM Job WHERE MATCH (Name) AGAINST (%s IN BOOLEAN MODE) AND Id > %s ORDER BY Id LIMIT %s",
+                             (against, after_id, limit))
+    elif mode == 'contains':
+        mysql_cursor.execute("SELECT Id, Name FROM Job WHERE Name LIKE %s AND Id > %s ORDER BY Id LIMIT %s",
+                             (f"%{escape_like(search_term)}%", after_id, limit))
+    elif mode == 'prefix':
+        mysql_cursor.execute("SELECT Id, Name FROM Job WHERE Name LIKE %s AND Id > %s ORDER BY Id LIMIT %s",
+                             (f"{escape_like(search_term)}%", after_id, limit))
+    else:
+        raise ValueError(f"Unknown job search mode {mode}")
+    return mysql_cursor.fetchall()
+
+def download_data(mysql_connection, mysql_cursor, service_account_file_path, bucket_name, logger, workers=1, verify_crc=True, manifest=None, preview_level=16, page_size=100, search_mode='prefix', replica=None, storage_client=None):
+
+    # one GCS client for every selected job
+    if storage_client is None:
+        storage_client = get_storage_client(service_account_file_path)
+
+    # searches read from the local replica, brought up to date once when the UI opens
+    if replica is not None and mysql_cursor is None:
+        logger.warning("No Cloud SQL connection, the metadata replica is not synced")
+    elif replica is not None:
+        try:
+            counts = replica.sync(mysql_cursor, children=CHILD_TABLES + [("PathStorage", "job_id")])
+            logger.info(f"Metadata replica synced: {counts}")
+        except Exception as e:
+            logger.warning(f"Could not sync the metadata replica, searching the last synced copy: {e}")
+
+    # keyset of the list shown: search term, last Id loaded, and whether the last page was reached
+    listing = {'term': "", 'last_id': 0, 'exhausted': False}
+
+    def load_page():
+        """Appends the next page of matching jobs to the list."""
+        if listing['exhausted']:
+            return
+        if replica is not None:
+            data = replica.search_jobs(listing['term'], listing['last_id'], page_size, search_mode)
         else:
-            mysql_cursor.execute("SELECT id, Name FROM Job")
-        return mysql_cursor.fetchall()
+            data = search_jobs(mysql_cursor, listing['term'], listing['last_id'], page_size, search_mode)
+        for job_id, job_name in data:
+            job_list.insert('', tk.END, iid=str(job_id), values=(job_id, job_name))
+        if data:
+            listing['last_id'] = data[-1][0]
+        listing['exhausted'] = len(data) < page_size
 
     def refresh_list(search_term=""):
         """Refreshes the job list based on the search term."""
-        for widget in second_frame.winfo_children():
-            widget.destroy()
+        job_list.delete(*job_list.get_children())
+        listing.update(term=search_term, last_id=0, exhausted=False)
+        load_page()
 
-        data = fetch_filtered_data(search_term)
-        for job_id, job_name in data:
-            var = tk.StringVar()
-            cb = ttk.Checkbutton(second_frame, text=f"{job_id} - {job_name}", variable=var, onvalue=f"{job_id}", offvalue="")
-            cb.pack(anchor='w', padx=10, pady=5)
-            checkboxes.append(var)
+    def on_scroll(first, last):
+        """Keeps the scrollbar in sync and loads the next page once the end of the list is visible."""
+        scrollbar.set(first, last)
+        if float(last) >= 1.0:
+            app.after_idle(load_page)
 
     def download_selected():
-        selected_items = [var.get() for var in checkboxes if var.get()]
+        selected_items = job_list.selection()
         for job_id in selected_items:
-            download_from_cloud(job_id, service_account_file_path, bucket_name, mysql_cursor, logger)
+            download_from_cloud(job_id, service_account_file_path, bucket_name, mysql_cursor, logger,
+                                storage_client=storage_client, workers=workers, verify_crc=verify_crc, manifest=manifest,
+                                replica=replica)
             local_path = f'{job_id}/Acquire_0/e96_wells'
-            downloade96_from_cloud(job_id, local_path, service_account_file_path, bucket_name)
+            downloade96_from_cloud(job_id, local_path, service_account_file_path, bucket_name, storage_client=storage_client)
+
+    def download_selected_preview():
+        selected_items = job_list.selection()
+        for job_id in selected_items:
+            download_from_cloud(job_id, service_account_file_path, bucket_name, mysql_cursor, logger,
+                                storage_client=storage_client, workers=workers, verify_crc=verify_crc, manifest=manifest,
+                                level=preview_level, replica=replica)
 
     app = tk.Tk()
     app.title('Data Download UI')
@@ -372,29 +1650,30 @@ def download_data(mysql_connection, mysql_cursor, service_account_file_path, buc
 
     search_btn = ttk.Button(app, text="Search", command=lambda: refresh_list(search_var.get()))
     search_btn.pack(pady=10)
+    search_entry.bind('<Return>', lambda e: refresh_list(search_var.get()))
 
-    canvas_width, canvas_height = 400, 500
-
-    # Create the main frame and canvas with a scrollbar
+    # Create the main frame and the job list with a scrollbar
     main_frame = ttk.Frame(app)
     main_frame.pack(pady=20, padx=20)
 
-    canvas = tk.Canvas(main_frame, width=canvas_width, height=canvas_height)
-    canvas.pack(side=tk.LEFT)
+    # a Treeview only draws the visible rows, unlike one Checkbutton widget per job
+    job_list = ttk.Treeview(main_frame, columns=("id", "name"), show="headings", selectmode="extended", height=20)
+    job_list.heading("id", text="Id")
+    job_list.heading("name", text="Name")
+    job_list.column("id", width=60, anchor='e')
+    job_list.column("name", width=340)
+    job_list.pack(side=tk.LEFT)
 
-    scrollbar = ttk.Scrollbar(main_frame, orient=tk.VERTICAL, command=canvas.yview)
+    scrollbar = ttk.Scrollbar(main_frame, orient=tk.VERTICAL, command=job_list.yview)
     scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
 
-    canvas.configure(yscrollcommand=scrollbar.set)
-    canvas.bind('<Configure>', lambda e: canvas.configure(scrollregion=canvas.bbox("all")))
-
-    second_frame = ttk.Frame(canvas)
-    canvas.create_window((0, 0), window=second_frame, anchor="nw")
+    job_list.configure(yscrollcommand=on_scroll)
 
-    # Initialize the checkboxes using the refresh function
-    checkboxes = []
     refresh_list()  # Call this to populate the list initially.
 
+    preview_btn = ttk.Button(app, text=f"Download Preview (1/{preview_level})", command=download_selected_preview)
+    preview_btn.pack(pady=(20, 0))
+
     btn = ttk.Button(app, text="Download Selected", command=download_selected)
     btn.pack(pady=20)
 
@@ -421,38 +1700,115 @@ def main():
     service_account_file_path = config["service_account_file_path"]
     bucket_name = config["bucket_name"]
     data_source = config["data_source"]
+    upload_workers = config.get("upload_workers", 8)
+    upload_retries = config.get("upload_retries", 3)
+    upload_verify_crc = config.get("upload_verify_crc", False)
+    insert_batch_size = config.get("insert_batch_size", 500)
+    insert_on_duplicate = config.get("insert_on_duplicate", "ignore")
+    journal = open_journal(config.get("journal_file"))
+    download_workers = config.get("download_workers", 8)
+    download_verify_crc = config.get("download_verify_crc", True)
+    manifest = open_manifest(config.get("manifest_file"))
+    pack_chunk_bytes = config.get("pack_chunk_mb", 0) * 1024 * 1024
+    preview_factors = config.get("preview_factors", [])
+    preview_download_level = config.get("preview_download_level", 16)
+    job_page_size = config.get("job_page_size", 100)
+    job_search_mode = config.get("job_search_mode", "prefix")
+    replica = open_replica(config.get("replica_file"))
+    metrics_file = config.get("metrics_file")
+    # per-stage counters and latency histograms, refreshed in Prometheus text format while the run goes on
+    METRICS.start_export(config.get("prometheus_file"), config.get("metrics_interval", 15))
+    focus_workers = config.get("focus_workers", 0)
+    pipeline_queue_size = config.get("pipeline_queue_size", 0)
+    pipeline_extract_jobs = config.get("pipeline_extract_jobs", 20)
+    upload_shards = config.get("upload_shards", 1)
+    shard_partition = config.get("shard_partition", "range")
+    mysql_pool_size = config.get("mysql_pool_size", 0)
+    mysql_retries = config.get("mysql_retries", 3)
 
     logger = setup_logger()
+    storage_client = None
+    mysql_connection = mysql_cursor = sqlce_connection = sqlce_cursor = None
 
     try:
-        # Connect to databases
-        mysql_connection, mysql_cursor = connect_to_mysql(db_host, db_name, db_user, db_password)
-        sqlce_connection, sqlce_cursor = connect_to_sqlce(data_source)
+        # Connect to databases, a download with a replica still works while Cloud SQL is unreachable
+        try:
+            mysql_connection, mysql_cursor = connect_to_mysql(db_host, db_name, db_user, db_password, config.get("scan_staging_dir"))
+        except mysql.connector.Error as e:
+            if args.mode != "download" or replica is None:
+                raise
+            logger.warning(f"Cloud SQL is unreachable, searching the last synced metadata replica: {e}")
+        if mysql_connection is not None and migrate_path_storage(mysql_connection, mysql_cursor):
+            logger.info("Added the level column to PathStorage")
+        if mysql_connection is not None:
+            for index in migrate_job_search(mysql_connection, mysql_cursor):
+                logger.info(f"Added the {index} index to Job")
+        # only the upload reads SQL CE and writes through the pool
+        mysql_pool = None
+        if args.mode == "upload":
+            sqlce_connection, sqlce_cursor = connect_to_sqlce(data_source)
+            mysql_pool = connect_pool(db_host, db_name, db_user, db_password, mysql_pool_size, mysql_retries,
+                                      config.get("scan_staging_dir"))
         
-        storage_client = storage.Client.from_service_account_json(service_account_file_path)
+        # GCS, or a directory tree for offline runs and on-prem mirrors
+        storage_client = storage_from_config(config)
         bucket = storage_client.bucket(bucket_name)
 
-        if mysql_connection.is_connected():
+        if mysql_connection is not None and mysql_connection.is_connected():
             print("Connected to the database")
-            print(list_buckets(service_account_file_path))
+            print(list_buckets(service_account_file_path, storage_client))
         else:
             print("Failed to connect to the database")
             
     
-        if args.mode == "upload":
-            upload_data(mysql_connection, mysql_cursor, sqlce_connection, sqlce_cursor, service_account_file_path, bucket_name, data_source, logger)
+        if args.mode == "upload" and upload_shards > 1:
+            upload_sharded(config, sqlce_cursor, logger, upload_shards, shard_partition,
+                           plan_file=config.get("shard_plan_file", "shard_plan.json"), journal=journal)
+        elif args.mode == "upload" and pipeline_queue_size:
+            asyncio.run(upload_data_pipelined(mysql_connection, mysql_cursor, sqlce_connection, sqlce_cursor, service_account_file_path, bucket_name, data_source, logger,
+                                              workers=upload_workers, retries=upload_retries, verify_crc=upload_verify_crc,
+                                              batch_size=insert_batch_size, on_duplicate=insert_on_duplicate,
+                                              journal=journal, manifest=manifest, pack_chunk_bytes=pack_chunk_bytes,
+                                              preview_factors=preview_factors, focus_workers=focus_workers,
+                                              queue_size=pipeline_queue_size, extract_jobs=pipeline_extract_jobs,
+                                              mysql_pool=mysql_pool, scan_staging_dir=config.get("scan_staging_dir"),
+                                              storage_client=storage_client))
+        elif args.mode == "upload":
+            upload_data(mysql_connection, mysql_cursor, sqlce_connection, sqlce_cursor, service_account_file_path, bucket_name, data_source, logger,
+                        journal=journal, manifest=manifest, mysql_pool=mysql_pool, storage_client=storage_client,
+                        **upload_options(config))
         elif args.mode == "download":
-            download_data(mysql_connection, mysql_cursor, service_account_file_path, bucket_name, logger)
+            download_data(mysql_connection, mysql_cursor, service_account_file_path, bucket_name, logger,
+                          workers=download_workers, verify_crc=download_verify_crc, manifest=manifest,
+                          preview_level=preview_download_level, page_size=job_page_size, search_mode=job_search_mode,
+                          replica=replica, storage_client=storage_client)
 
 
     except Exception as e:
         logger.error(f"An unexpected error occurred: {e}")  
     finally:
         # Close database connections
-        sqlce_cursor.close()
-        sqlce_connection.close()
-        mysql_cursor.close()
-        mysql_connection.close()
+        if sqlce_connection is not None:
+            sqlce_cursor.close()
+            sqlce_connection.close()
+        if mysql_connection is not None:
+            mysql_cursor.close()
+            mysql_connection.close()
+        if journal is not None:
+            journal.close()
+        if manifest is not None:
+            manifest.close()
+        if replica is not None:
+            replica.close()
+        if storage_client is not None:
+            storage_client.close()
+
+        METRICS.stop_export()
+        for stage, stats in METRICS.summary()['stages'].items():
+            logger.info(f"{stage}: {stats['calls']} calls, {stats['items']} items, {stats['bytes'] / 1e6:.1f} MB, "
+                        f"{stats['seconds']:.1f} s, p50 {stats['p50_s']} s, p99 {stats['p99_s']} s, {stats['errors']} errors")
+        if metrics_file:
+            METRICS.write_json(metrics_file)
 
         logger.info("Data migration complete.")
 
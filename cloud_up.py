@@ -2,6 +2,7 @@ import os
 import logging
 import adodbapi
 import mysql.connector
+from db_pool import connect_pool, ensure_connected, is_transient
 from google.cloud import storage
 import json
 
@@ -119,22 +120,26 @@ def generate_paths(cursor, job_id, job_name):
 
 
 
-def store_paths(destination_cursor, job_id, local_path, cloud_path):
-    """Store local and cloud paths in the PathStorage table."""
+def store_paths(destination_cursor, job_id, local_path, cloud_path, connection=None):
+    """Store local and cloud paths in the PathStorage table.
+    connection: connection of destination_cursor, defaults to the global mysql_connection."""
     insert_query = "INSERT INTO PathStorage (job_id, local_path, cloud_path) VALUES (%s, %s, %s)"
     try:
         destination_cursor.execute(insert_query, (job_id, local_path, cloud_path))
-        mysql_connection.commit()
+        (connection or mysql_connection).commit()
     except Exception as e:
+        if is_transient(e):
+            raise
         print(f"Error storing paths for job_id {job_id}: {e}")
 
 # insert_data_into_mysql function and connection code 
-def insert_data_into_mysql(source_cursor, destination_cursor, table, column, job_id):
+def insert_data_into_mysql(source_cursor, destination_cursor, table, column, job_id, commit=True):
     '''
     source_cursor: the SQLCE cursor where the data from
     destination_cursor: the google MySQL cursor where the date insert
     table: table name 
     job_id: index
+    commit: False leaves the commit to the caller, e.g. insert_job
 
     '''
 
@@ -147,11 +152,40 @@ def insert_data_into_mysql(source_cursor, destination_cursor, table, column, job
         
         try:
             destination_cursor.execute(insert_query, record)
-            mysql_connection.commit()
+            if commit:
+                mysql_connection.commit()
         except mysql.connector.IntegrityError as ie:
             print(f"Error inserting into {table}: {ie}")
             continue
 
+def insert_job(mysql_connection, mysql_cursor, sqlce_cursor, job):
+    '''
+    Insert a job and the rows of its child tables in one transaction,
+    so MySQLPool.run can repeat it after a transient error.
+    '''
+    job_id = job[0]
+    insert_query = f"INSERT INTO Job VALUES ({', '.join(['%s'] * len(job))})"
+    mysql_cursor.execute(insert_query, job)
+
+    # Use insert_data_into_mysql function for inserting data to tables 
+    insert_data_into_mysql(sqlce_cursor, mysql_cursor, "JobTask", "Job_id", job_id, commit=False)
+    insert_data_into_mysql(sqlce_cursor, mysql_cursor, "JobEvent", "Job_id", job_id, commit=False)
+    insert_data_into_mysql(sqlce_cursor, mysql_cursor, "AcquireTask", "JobTask_id", job_id, commit=False)
+    insert_data_into_mysql(sqlce_cursor, mysql_cursor, "AcquireSettings", "OriginalAcquireTask_id", job_id, commit=False)
+    insert_data_into_mysql(sqlce_cursor, mysql_cursor, "InstrumentInformation", "Id", job_id, commit=False)
+    insert_data_into_mysql(sqlce_cursor, mysql_cursor, "ScanArea", "AcquireSettings_id", job_id, commit=False)
+    mysql_connection.commit()
+
+def mysql_call(mysql_pool, mysql_connection, mysql_cursor, func):
+    '''
+    Run func(connection, cursor) on a pooled connection, retried on a fresh one after transient errors,
+    or on the single connection of the run after checking it is still alive.
+    '''
+    if mysql_pool is not None:
+        return mysql_pool.run(func)
+    ensure_connected(mysql_connection)
+    return func(mysql_connection, mysql_cursor)
+
 def list_buckets(service_account_file):
     # Instantiates a storage client with the service account file
     storage_client = storage.Client.from_service_account_json(service_account_file)
@@ -162,7 +196,7 @@ def list_buckets(service_account_file):
     for bucket in buckets:
         print(bucket.name)
 
-def copy_to_cloud(local_path, cloud_path, service_account_file_path, bucket_name):
+def copy_to_cloud(local_path, cloud_path, service_account_file_path, bucket_name, job_id, mysql_cursor=None, mysql_pool=None):
     """
     Copy data from local path to Google Cloud Storage.
     
@@ -170,6 +204,8 @@ def copy_to_cloud(local_path, cloud_path, service_account_file_path, bucket_name
     cloud_path: The desired path in GCS where data will be stored.
     service_account_file_path: Path to your service account json file.
     bucket_name: Name of the GCS bucket where data will be uploaded.
+    job_id: job the paths are stored for in PathStorage.
+    mysql_cursor, mysql_pool: where PathStorage is written, see mysql_call.
     """
     
     # Check if local path exists
@@ -187,7 +223,8 @@ def copy_to_cloud(local_path, cloud_path, service_account_file_path, bucket_name
             # Check if the blob exists in GCS
             if not blob.exists():
                 blob.upload_from_filename(local_file)
-                store_paths(mysql_cursor, job_id, local_path, cloud_path)
+                mysql_call(mysql_pool, mysql_connection, mysql_cursor,
+                           lambda connection, cursor: store_paths(cursor, job_id, local_path, cloud_path, connection))
                 print('copy:',local_path,'to cloud:',cloud_path)
             else:
                 print(f"File {cloud_file_path} already exists in GCS. Skipping upload.")
@@ -244,6 +281,9 @@ def main():
         # Connect to databases
         mysql_connection, mysql_cursor = connect_to_mysql(db_host, db_name, db_user, db_password)
         sqlce_connection, sqlce_cursor = connect_to_sqlce(data_source)
+        # the inserts borrow a connection and are retried on transient errors, None keeps the single connection
+        mysql_pool = connect_pool(db_host, db_name, db_user, db_password,
+                                  config.get("mysql_pool_size", 0), config.get("mysql_retries", 3))
         
         storage_client = storage.Client.from_service_account_json(service_account_file_path)
         bucket = storage_client.bucket(bucket_name)
@@ -280,25 +320,17 @@ def main():
                 if not os.path.exists(local_path):
                     logger.warning(f"Error: Local path {local_path} does not exist. Skipping.")
                     continue
-                copy_to_cloud(local_path, cloud_path, service_account_file_path, bucket_name) 
+                copy_to_cloud(local_path, cloud_path, service_account_file_path, bucket_name, job_id, mysql_cursor, mysql_pool)
                 files_exist = True
 
             if not files_exist:
                 continue
 
             try:
-                insert_query = f"INSERT INTO Job VALUES ({', '.join(['%s'] * len(job))})"
-                mysql_cursor.execute(insert_query, job)
-                mysql_connection.commit()  # Changed from mysql_connection to mysql_conn
-
-                # Use insert_data_into_mysql function for inserting data to tables 
-
-                insert_data_into_mysql(sqlce_cursor, mysql_cursor, "JobTask", "Job_id", job_id)
-                insert_data_into_mysql(sqlce_cursor, mysql_cursor, "JobEvent", "Job_id", job_id)
-                insert_data_into_mysql(sqlce_cursor, mysql_cursor, "AcquireTask", "JobTask_id", job_id)
-                insert_data_into_mysql(sqlce_cursor, mysql_cursor, "AcquireSettings", "OriginalAcquireTask_id", job_id)
-                insert_data_into_mysql(sqlce_cursor, mysql_cursor, "InstrumentInformation", "Id", job_id)
-                insert_data_into_mysql(sqlce_cursor, mysql_cursor, "ScanArea", "AcquireSettings_id", job_id)
+                # a pooled connection is pinged first and the job retried on transient errors,
+                # the single connection is reconnected if the server dropped it while the files were uploading
+                mysql_call(mysql_pool, mysql_connection, mysql_cursor,
+                           lambda connection, cursor: insert_job(connection, cursor, sqlce_cursor, job))
 
             except mysql.connector.IntegrityError as ie:
                 logger.error(f"Error inserting data for Job ID {job_id}: {ie}")
@@ -134,8 +134,11 @@ CREATE TABLE PathStorage (
     job_id INT NOT NULL,
     local_path VARCHAR(255) NOT NULL,
     cloud_path VARCHAR(255) NOT NULL,
+    level INT NOT NULL DEFAULT 0
 );
 
+-- existing databases get the level column and IX_PathStorage_Job from cloud.migrate_path_storage at startup
+
 
 CREATE INDEX IX_OriginalAcquireTask ON AcquireSettings (OriginalAcquireTask_id ASC);
 
@@ -155,6 +158,14 @@ CREATE INDEX IX_AcquireSettings ON ScanArea (AcquireSettings_id ASC);
 
 CREATE INDEX idx_JobTask_id ON AcquireTask (JobTask_id);
 
+-- job search in the download UI: prefix search (Name LIKE 'term%') and word search (MATCH ... AGAINST),
+-- existing databases get both indexes from cloud.migrate_job_search at startup
+CREATE INDEX IX_Job_Name ON Job (Name);
+
+CREATE FULLTEXT INDEX FT_Job_Name ON Job (Name);
+
+CREATE INDEX IX_PathStorage_Job ON PathStorage (job_id, level);
+
  
 ALTER TABLE AcquireSettings
 ADD FOREIGN KEY (OriginalAcquireTask_id)
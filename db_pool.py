@@ -0,0 +1,100 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+import mysql.connector
+from mysql.connector import pooling
+
+
+# can't connect, server has gone away, lost connection during query, lock wait timeout, deadlock
+TRANSIENT_ERRORS = {2003, 2006, 2013, 2055, 1205, 1213}
+
+
+def is_transient(error):
+    '''
+    True for errors worth retrying on a fresh connection, e.g. a Cloud SQL connection dropped overnight.
+    '''
+    return isinstance(error, mysql.connector.Error) and error.errno in TRANSIENT_ERRORS
+
+def local_infile_options(local_infile_dir=None):
+    '''
+    Connection arguments that let LOAD DATA LOCAL INFILE read files under local_infile_dir only,
+    the server can't ask for any other file the process can read. None leaves local infiles off.
+    '''
+    if not local_infile_dir:
+        return {}
+    return {'allow_local_infile_in_path': os.path.abspath(local_infile_dir)}
+
+def ensure_connected(connection, attempts=3, delay=1.0):
+    '''
+    Health check before a connection is used, reconnects it in place if the server dropped it.
+    Cursors of the connection stay valid since the connection object is reused.
+    '''
+    connection.ping(reconnect=True, attempts=attempts, delay=delay)
+    return connection
+
+
+class MySQLPool:
+    '''
+    Fixed size pool of MySQL connections shared by the upload and insert workers.
+
+    Borrowing blocks while every connection is in use instead of raising like
+    mysql.connector's own pool, every borrowed connection is pinged (and reconnected)
+    first, and run() retries a unit of work on transient errors.
+    '''
+
+    def __init__(self, host, database, user, password, pool_size=4, retries=3, retry_delay=1.0, pool_name="migration", local_infile_dir=None):
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.pool_size = pool_size
+        self.pool = pooling.MySQLConnectionPool(pool_name=pool_name, pool_size=pool_size, pool_reset_session=True,
+                                                host=host, database=database, user=user, password=password,
+                                                **local_infile_options(local_infile_dir))
+        self._slots = threading.BoundedSemaphore(pool_size)
+
+    @contextmanager
+    def connection(self):
+        '''
+        Borrow a healthy connection, it goes back to the pool when the block exits.
+        '''
+        with self._slots:
+            connection = self.pool.get_connection()
+            try:
+                yield ensure_connected(connection, self.retries, self.retry_delay)
+            finally:
+                connection.close()
+
+    def run(self, func, *args, **kwargs):
+        '''
+        Call func(connection, cursor, *args, **kwargs) on a borrowed connection.
+        On a transient error the transaction is rolled back and the whole call is retried
+        on a reconnected connection, so func has to be safe to repeat.
+        '''
+        for attempt in range(self.retries + 1):
+            try:
+                with self.connection() as connection:
+                    cursor = connection.cursor()
+                    try:
+                        return func(connection, cursor, *args, **kwargs)
+                    except mysql.connector.Error:
+                        try:
+                            connection.rollback()
+                        except mysql.connector.Error:
+                            pass
+                        raise
+                    finally:
+                        cursor.close()
+            except mysql.connector.Error as e:
+                if not is_transient(e) or attempt == self.retries:
+                    raise
+                time.sleep(self.retry_delay * 2 ** attempt)
+
+
+def connect_pool(host, db_name, user, password, pool_size=4, retries=3, local_infile_dir=None):
+    '''
+    Open the pool, None for pool_size keeps the single connection of connect_to_mysql.
+    local_infile_dir: see local_infile_options
+    '''
+    if not pool_size:
+        return None
+    return MySQLPool(host, db_name, user, password, pool_size, retries, local_infile_dir=local_infile_dir)
@@ -0,0 +1,61 @@
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from stack_loader import iter_stacks
+
+
+def laplacian_variance(image):
+    '''
+    Sharpness of a single frame, variance of its 4-neighbour Laplacian.
+    '''
+    return laplacian_variance_stack(np.asarray(image)[np.newaxis])[0]
+
+def laplacian_variance_stack(stack, batch_size=4):
+    '''
+    Sharpness of every slice of a (z, h, w) uint8 stack in one vectorised pass.
+
+    The 4-neighbour Laplacian (the cv2.Laplacian ksize=1 kernel) is computed with array
+    slices on the interior pixels, in int16 since its range is -1020..1020.
+    batch_size slices are processed at a time to bound the temporary arrays.
+    return: (z,) float array of Laplacian variances
+    '''
+    stack = np.asarray(stack)
+    scores = np.empty(len(stack))
+    for start in range(0, len(stack), batch_size):
+        block = stack[start:start + batch_size].astype(np.int16)
+        laplacian = block[:, 1:-1, :-2] + block[:, 1:-1, 2:]
+        laplacian += block[:, :-2, 1:-1]
+        laplacian += block[:, 2:, 1:-1]
+        laplacian -= 4 * block[:, 1:-1, 1:-1]
+        flat = laplacian.reshape(len(block), -1).astype(np.float32)
+        scores[start:start + len(block)] = flat.var(axis=1)
+    return scores
+
+def best_z_levels(local_path, repetitions=None, workers=4):
+    '''
+    Sharpest z-slice of every repetition of a scan area.
+    Stacks are decoded in the background while the previous one is scored.
+    return: dict of repetition -> (best z, scores)
+    '''
+    results = {}
+    for repetition, stack in iter_stacks(local_path, repetitions, workers=workers):
+        if len(stack) == 0:
+            continue
+        scores = laplacian_variance_stack(stack)
+        results[repetition] = (int(np.argmax(scores)), scores)
+    return results
+
+def score_scan_areas(scan_areas, workers=4):
+    '''
+    Focus every scan area of a job in parallel.
+    scan_areas: list of (scan_area_id, local_path)
+    return: list of (scan_area_id, repetition, best z)
+    '''
+    def score(item):
+        scan_area_id, local_path = item
+        return [(scan_area_id, repetition, best_z) for repetition, (best_z, _) in best_z_levels(local_path).items()]
+
+    rows = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for scan_area_rows in executor.map(score, scan_areas):
+            rows.extend(scan_area_rows)
+    return rows
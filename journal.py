@@ -0,0 +1,160 @@
+import os
+import sqlite3
+import threading
+import time
+
+
+# states a file or table moves through, in order
+PENDING = 'pending'
+UPLOADED = 'uploaded'
+VERIFIED = 'verified'
+INSERTED = 'inserted'
+# a job that had no local data to upload
+EMPTY = 'empty'
+
+DONE_FILE_STATES = (UPLOADED, VERIFIED)
+
+
+class UploadJournal:
+    '''
+    Crash-safe record of the migration progress, kept in a local SQLite file.
+
+    Every file and every table of a job has its own state, so a restart only redoes
+    the unfinished work and jobs can finish out of order.
+    SQLite commits are durable (WAL with synchronous=FULL), so a crash loses at most
+    the marks that were not flushed yet, which only costs re-uploading those files.
+    '''
+
+    def __init__(self, filename='upload_journal.db', flush_every=64):
+        self.filename = filename
+        self.flush_every = flush_every
+        self._pending_marks = 0
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=FULL")
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id INTEGER PRIMARY KEY,
+                state TEXT NOT NULL,
+                updated REAL
+            );
+            CREATE TABLE IF NOT EXISTS files (
+                cloud_file_path TEXT PRIMARY KEY,
+                job_id INTEGER NOT NULL,
+                local_file TEXT,
+                state TEXT NOT NULL,
+                updated REAL
+            );
+            CREATE INDEX IF NOT EXISTS IX_files_job ON files (job_id);
+            CREATE TABLE IF NOT EXISTS tables (
+                job_id INTEGER NOT NULL,
+                table_name TEXT NOT NULL,
+                state TEXT NOT NULL,
+                updated REAL,
+                PRIMARY KEY (job_id, table_name)
+            );
+        ''')
+        self.connection.commit()
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+    def flush(self):
+        with self._lock:
+            self.connection.commit()
+            self._pending_marks = 0
+
+    def _mark(self, query, params):
+        with self._lock:
+            self.connection.execute(query, params)
+            self._pending_marks += 1
+            if self._pending_marks >= self.flush_every:
+                self.connection.commit()
+                self._pending_marks = 0
+
+    # jobs
+    def job_state(self, job_id):
+        row = self.connection.execute("SELECT state FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return row[0] if row else None
+
+    def mark_job(self, job_id, state):
+        self._mark("INSERT OR REPLACE INTO jobs (job_id, state, updated) VALUES (?, ?, ?)", (job_id, state, time.time()))
+        self.flush()
+
+    def high_water_mark(self):
+        '''
+        Highest job id below which every job the journal has seen is finished.
+        Used to narrow the SQLCE extraction, like last_uploaded.txt used to.
+        '''
+        row = self.connection.execute("SELECT MIN(job_id) FROM jobs WHERE state NOT IN (?, ?)", (INSERTED, EMPTY)).fetchone()
+        if row[0] is not None:
+            return row[0] - 1
+        row = self.connection.execute("SELECT MAX(job_id) FROM jobs").fetchone()
+        return row[0] or 0
+
+    def is_empty(self):
+        return self.connection.execute("SELECT 1 FROM jobs LIMIT 1").fetchone() is None
+
+    def seed(self, last_uploaded_id):
+        '''
+        Record every job up to last_uploaded_id as finished, for progress made without this journal:
+        last_uploaded.txt of the runs before it, or the shards of a sharded upload.
+        '''
+        if last_uploaded_id > 0:
+            with self._lock:
+                self.connection.execute("UPDATE jobs SET state = ?, updated = ? WHERE job_id <= ? AND state NOT IN (?, ?)",
+                                        (INSERTED, time.time(), last_uploaded_id, INSERTED, EMPTY))
+            self.mark_job(last_uploaded_id, INSERTED)
+
+    # files
+    def done_files(self, job_id):
+        '''
+        set of cloud file paths of a job that are already uploaded, for O(1) lookups
+        '''
+        placeholders = ', '.join(['?'] * len(DONE_FILE_STATES))
+        rows = self.connection.execute(
+            f"SELECT cloud_file_path FROM files WHERE job_id = ? AND state IN ({placeholders})",
+            (job_id, *DONE_FILE_STATES))
+        return {row[0] for row in rows}
+
+    def mark_file(self, job_id, local_file, cloud_file_path, state):
+        self._mark("INSERT OR REPLACE INTO files (cloud_file_path, job_id, local_file, state, updated) VALUES (?, ?, ?, ?, ?)",
+                   (cloud_file_path, job_id, local_file, state, time.time()))
+
+    # tables
+    def table_state(self, job_id, table):
+        row = self.connection.execute("SELECT state FROM tables WHERE job_id = ? AND table_name = ?", (job_id, table)).fetchone()
+        return row[0] if row else None
+
+    def mark_table(self, job_id, table, state):
+        self._mark("INSERT OR REPLACE INTO tables (job_id, table_name, state, updated) VALUES (?, ?, ?, ?)",
+                   (job_id, table, state, time.time()))
+        self.flush()
+
+
+def read_last_uploaded(progress_file):
+    try:
+        with open(progress_file, 'r') as f:
+            return int(f.read().strip())
+    except (FileNotFoundError, ValueError):
+        return 0
+
+def open_journal(filename, progress_file='last_uploaded.txt', last_uploaded_id=0):
+    '''
+    Open the journal, None keeps the old last_uploaded.txt behaviour.
+    A new journal is seeded from progress_file, the last_uploaded.txt of the runs before it.
+    last_uploaded_id: every job up to it is known to be finished, a journal behind it is moved up
+    '''
+    if not filename:
+        return None
+    directory = os.path.dirname(filename)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    journal = UploadJournal(filename)
+    if progress_file and journal.is_empty():
+        journal.seed(read_last_uploaded(progress_file))
+    if journal.high_water_mark() < last_uploaded_id:
+        journal.seed(last_uploaded_id)
+    return journal
@@ -0,0 +1,107 @@
+import os
+import sqlite3
+import threading
+import base64
+import google_crc32c
+
+
+class ContentManifest:
+    '''
+    Local record of what every synced file looked like when it was last uploaded or downloaded.
+
+    Entries are keyed by absolute local path and hold (size, mtime_ns, crc32c, generation, cloud_path).
+    A file whose stat() still matches its entry is known to be in the bucket at that generation,
+    so it can be skipped without a request and without reading it. Only files whose stat changed
+    are hashed again.
+    '''
+
+    def __init__(self, filename='content_manifest.db', flush_every=256):
+        self.filename = filename
+        self.flush_every = flush_every
+        self._pending_marks = 0
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS manifest (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                crc32c TEXT,
+                generation INTEGER,
+                cloud_path TEXT
+            )
+        ''')
+        self.connection.execute("CREATE INDEX IF NOT EXISTS IX_manifest_cloud_path ON manifest (cloud_path)")
+        self.connection.commit()
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+    def flush(self):
+        with self._lock:
+            self.connection.commit()
+            self._pending_marks = 0
+
+    def lookup(self, local_file):
+        '''
+        return: (size, mtime_ns, crc32c, generation, cloud_path) or None
+        '''
+        with self._lock:
+            return self.connection.execute(
+                "SELECT size, mtime_ns, crc32c, generation, cloud_path FROM manifest WHERE path = ?",
+                (os.path.abspath(local_file),)).fetchone()
+
+    def unchanged(self, local_file, stat=None):
+        '''
+        Return the entry if the file's size and mtime still match it, else None.
+        '''
+        entry = self.lookup(local_file)
+        if entry is None:
+            return None
+        if stat is None:
+            try:
+                stat = os.stat(local_file)
+            except FileNotFoundError:
+                return None
+        if entry[0] != stat.st_size or entry[1] != stat.st_mtime_ns:
+            return None
+        return entry
+
+    def crc32c(self, local_file, stat=None):
+        '''
+        base64 CRC32C of the file, hashed only when its stat changed since the last entry.
+        '''
+        entry = self.unchanged(local_file, stat)
+        if entry is not None and entry[2]:
+            return entry[2]
+        checksum = google_crc32c.Checksum()
+        with open(local_file, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                checksum.update(chunk)
+        return base64.b64encode(checksum.digest()).decode('utf-8')
+
+    def record(self, local_file, crc32c=None, generation=None, cloud_path=None, stat=None):
+        if stat is None:
+            stat = os.stat(local_file)
+        with self._lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO manifest (path, size, mtime_ns, crc32c, generation, cloud_path) VALUES (?, ?, ?, ?, ?, ?)",
+                (os.path.abspath(local_file), stat.st_size, stat.st_mtime_ns, crc32c, generation, cloud_path))
+            self._pending_marks += 1
+            if self._pending_marks >= self.flush_every:
+                self.connection.commit()
+                self._pending_marks = 0
+
+
+def open_manifest(filename):
+    '''
+    Open the manifest, None disables it.
+    '''
+    if not filename:
+        return None
+    directory = os.path.dirname(filename)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    return ContentManifest(filename)
@@ -0,0 +1,215 @@
+import os
+import json
+import time
+import inspect
+import threading
+import functools
+from collections import defaultdict
+
+
+# upper bounds in seconds of the latency histogram, the same for every stage
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+class StageStats:
+    '''
+    Counters and latency histogram of one stage, overall or for one job.
+    '''
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.items = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def add(self, seconds, items=0, nbytes=0, errors=0):
+        self.calls += 1
+        self.errors += errors
+        self.items += items
+        self.bytes += nbytes
+        self.seconds += seconds
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.buckets[index] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+
+    def quantile(self, q):
+        '''
+        Upper bound of the histogram bucket holding the q-quantile, None above the last bound.
+        '''
+        rank = q * self.calls
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+    def as_dict(self):
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'items': self.items,
+            'bytes': self.bytes,
+            'seconds': round(self.seconds, 4),
+            'mean_s': round(self.seconds / self.calls, 4) if self.calls else None,
+            'p50_s': self.quantile(0.5),
+            'p90_s': self.quantile(0.9),
+            'p99_s': self.quantile(0.99),
+            'items_per_s': round(self.items / self.seconds, 2) if self.seconds else None,
+            'MB_per_s': round(self.bytes / 1e6 / self.seconds, 2) if self.seconds else None,
+        }
+
+
+class Metrics:
+    '''
+    Per-stage and per-job counters, byte totals and latency histograms of a migration run.
+
+    Stages are recorded by the timed decorator. summary() is the machine-readable report
+    written at the end of a run, and start_export() keeps a Prometheus text file up to date
+    while it runs, e.g. for node_exporter's textfile collector.
+    '''
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        '''
+        Start over with empty counters, e.g. in a forked shard process. The parent's export
+        thread does not exist in the child, so its state is dropped rather than stopped.
+        '''
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.stages = defaultdict(StageStats)
+        self.jobs = defaultdict(lambda: defaultdict(StageStats))
+        self._export_stop = None
+        self._export_thread = None
+
+    def observe(self, stage, seconds, job_id=None, items=0, nbytes=0, errors=0):
+        with self._lock:
+            self.stages[stage].add(seconds, items, nbytes, errors)
+            if job_id is not None:
+                self.jobs[str(job_id)][stage].add(seconds, items, nbytes, errors)
+
+    def summary(self):
+        with self._lock:
+            return {
+                'started': self.started,
+                'elapsed_s': round(time.time() - self.started, 3),
+                'latency_buckets_s': list(LATENCY_BUCKETS),
+                'stages': {stage: stats.as_dict() for stage, stats in self.stages.items()},
+                'histograms': {stage: list(stats.buckets) for stage, stats in self.stages.items()},
+                'jobs': {job_id: {stage: stats.as_dict() for stage, stats in stages.items()}
+                         for job_id, stages in self.jobs.items()},
+            }
+
+    def write_json(self, filename):
+        write_atomic(filename, json.dumps(self.summary(), indent=4))
+
+    def prometheus_text(self):
+        '''
+        Stage totals in the Prometheus text exposition format, jobs are left out to keep the label count bounded.
+        '''
+        counters = [
+            ('metdb_stage_calls_total', 'Calls of a migration stage.', 'calls'),
+            ('metdb_stage_errors_total', 'Failed calls or failed files of a migration stage.', 'errors'),
+            ('metdb_stage_items_total', 'Files, paths or rows handled by a migration stage.', 'items'),
+            ('metdb_stage_bytes_total', 'Bytes moved by a migration stage.', 'bytes'),
+        ]
+        lines = []
+        with self._lock:
+            stages = sorted(self.stages.items())
+            for name, description, attribute in counters:
+                lines += [f"# HELP {name} {description}", f"# TYPE {name} counter"]
+                lines += [f'{name}{{stage="{stage}"}} {getattr(stats, attribute)}' for stage, stats in stages]
+
+            name = 'metdb_stage_duration_seconds'
+            lines += [f"# HELP {name} Latency of a migration stage.", f"# TYPE {name} histogram"]
+            for stage, stats in stages:
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, stats.buckets):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {stats.calls}')
+                lines.append(f'{name}_sum{{stage="{stage}"}} {stats.seconds}')
+                lines.append(f'{name}_count{{stage="{stage}"}} {stats.calls}')
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, filename):
+        write_atomic(filename, self.prometheus_text())
+
+    def start_export(self, filename, interval=15):
+        '''
+        Rewrite the Prometheus file every interval seconds from a background thread.
+        '''
+        if not filename or self._export_thread is not None:
+            return
+        self._export_stop = threading.Event()
+
+        def export():
+            while not self._export_stop.wait(interval):
+                self.write_prometheus(filename)
+
+        self._export_filename = filename
+        self._export_thread = threading.Thread(target=export, name='metrics-export', daemon=True)
+        self._export_thread.start()
+
+    def stop_export(self):
+        '''
+        Stop the background export and write the file one last time.
+        '''
+        if self._export_thread is None:
+            return
+        self._export_stop.set()
+        self._export_thread.join()
+        self._export_thread = None
+        self.write_prometheus(self._export_filename)
+
+
+def write_atomic(filename, text):
+    '''
+    Write to a temporary file and rename it, so readers never see a half-written file.
+    '''
+    directory = os.path.dirname(filename)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = filename + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, filename)
+
+
+# registry of the process, shared by every instrumented function
+METRICS = Metrics()
+
+
+def timed(stage, job=None, measure=None):
+    '''
+    Record every call of the decorated function as one observation of stage in METRICS.
+    job: name of the argument holding the job id, or a function of the bound arguments returning it
+    measure: function of the return value returning a dict with any of 'items', 'nbytes' and 'errors'
+    A call that raises counts as one error and the exception is passed on.
+    '''
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            job_id = None
+            if job is not None:
+                arguments = signature.bind_partial(*args, **kwargs).arguments
+                job_id = job(arguments) if callable(job) else arguments.get(job)
+            start = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            except Exception:
+                METRICS.observe(stage, time.perf_counter() - start, job_id, errors=1)
+                raise
+            METRICS.observe(stage, time.perf_counter() - start, job_id, **(measure(result) if measure else {}))
+            return result
+        return wrapper
+    return decorator
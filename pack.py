@@ -0,0 +1,159 @@
+import os
+import re
+import json
+import tempfile
+
+
+PACK_DIR = "pack"
+INDEX_NAME = "index.json"
+PACK_VERSION = 1
+
+
+def natural_key(path):
+    '''
+    Sort "<rep>/<z>.bmp" numerically so 10.bmp comes after 9.bmp.
+    '''
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', path)]
+
+def pack_prefix(cloud_path):
+    return cloud_path.replace('\\', '/').rstrip('/') + '/' + PACK_DIR
+
+def index_name(cloud_path):
+    return pack_prefix(cloud_path) + '/' + INDEX_NAME
+
+def chunk_name(cloud_path, chunk_index):
+    return pack_prefix(cloud_path) + f'/chunk_{chunk_index:05d}.bin'
+
+def list_frames(local_path):
+    '''
+    All files of a scan area as paths relative to local_path, in repetition/z order.
+    '''
+    frames = []
+    for dirpath, dirnames, filenames in os.walk(local_path):
+        for filename in filenames:
+            frames.append(os.path.relpath(os.path.join(dirpath, filename), local_path).replace(os.sep, '/'))
+    return sorted(frames, key=natural_key)
+
+def build_pack(local_path, chunk_bytes=256 * 1024 * 1024):
+    '''
+    Plan how the files of a scan area are laid out in chunks, without reading them.
+    A chunk is closed once it reaches chunk_bytes, files are never split across chunks.
+    return: index dict with 'version', 'chunks' (number of chunks), 'total_size'
+            and 'frames' {relative path: [chunk, offset, size]}
+    '''
+    frames = {}
+    chunk, offset, total = 0, 0, 0
+    for frame in list_frames(local_path):
+        size = os.path.getsize(os.path.join(local_path, frame))
+        if offset and offset + size > chunk_bytes:
+            chunk, offset = chunk + 1, 0
+        frames[frame] = [chunk, offset, size]
+        offset += size
+        total += size
+    return {'version': PACK_VERSION, 'chunks': chunk + 1 if frames else 0, 'total_size': total, 'frames': frames}
+
+def upload_pack(bucket, local_path, cloud_path, chunk_bytes=256 * 1024 * 1024):
+    '''
+    Upload one scan area as a few large chunk objects plus an offset index,
+    instead of one object per frame.
+    The index is written last, so a reader never sees an index for missing chunks.
+    An existing index that matches the local files means the pack is already complete.
+    return: the index dict, and False if the pack was already complete and nothing was uploaded
+    '''
+    index = build_pack(local_path, chunk_bytes)
+    existing = bucket.blob(index_name(cloud_path))
+    if existing.exists():
+        if json.loads(existing.download_as_bytes()) == index:
+            print(f"Pack for {cloud_path} already exists in GCS. Skipping upload.")
+            return index, False
+
+    by_chunk = {}
+    for frame, (chunk, offset, size) in index['frames'].items():
+        by_chunk.setdefault(chunk, []).append(frame)
+
+    for chunk, chunk_frames in sorted(by_chunk.items()):
+        # spill to disk above 64 MB so a chunk never has to fit in memory
+        with tempfile.SpooledTemporaryFile(max_size=64 * 1024 * 1024) as buffer:
+            for frame in chunk_frames:
+                with open(os.path.join(local_path, frame), 'rb') as f:
+                    buffer.write(f.read())
+            buffer.seek(0)
+            bucket.blob(chunk_name(cloud_path, chunk)).upload_from_file(buffer, content_type='application/octet-stream')
+
+    bucket.blob(index_name(cloud_path)).upload_from_string(json.dumps(index), content_type='application/json')
+    return index, True
+
+def load_index(bucket, cloud_path):
+    '''
+    return: index dict of a packed scan area, or None if cloud_path is not packed
+    '''
+    blob = bucket.blob(index_name(cloud_path))
+    if not blob.exists():
+        return None
+    return json.loads(blob.download_as_bytes())
+
+def read_frame(bucket, cloud_path, frame, index=None):
+    '''
+    Fetch a single frame with one HTTP range read.
+    frame: path relative to the scan area, e.g. "0/12.bmp"
+    '''
+    if index is None:
+        index = load_index(bucket, cloud_path)
+    chunk, offset, size = index['frames'][frame]
+    return bucket.blob(chunk_name(cloud_path, chunk)).download_as_bytes(start=offset, end=offset + size - 1)
+
+def read_frames(bucket, cloud_path, frames, index=None):
+    '''
+    Fetch several frames, merging frames that are adjacent in the same chunk into one range read.
+    A whole z-stack of one repetition usually comes back in a single request.
+    return: dict of frame -> bytes
+    '''
+    if index is None:
+        index = load_index(bucket, cloud_path)
+    located = sorted((index['frames'][frame] + [frame] for frame in frames))
+
+    result = {}
+    run = []
+    def fetch(run):
+        chunk, start = run[0][0], run[0][1]
+        end = run[-1][1] + run[-1][2]
+        data = bucket.blob(chunk_name(cloud_path, chunk)).download_as_bytes(start=start, end=end - 1)
+        for _, offset, size, frame in run:
+            result[frame] = data[offset - start:offset - start + size]
+
+    for item in located:
+        if run and (item[0] != run[-1][0] or item[1] != run[-1][1] + run[-1][2]):
+            fetch(run)
+            run = []
+        run.append(item)
+    if run:
+        fetch(run)
+    return result
+
+def download_pack(bucket, cloud_path, local_root_path, index=None):
+    '''
+    Restore the per-frame files of a packed scan area.
+    Each chunk is fetched once and split; every file is written to a temporary name
+    and renamed into place.
+    return: list of local paths written
+    '''
+    if index is None:
+        index = load_index(bucket, cloud_path)
+    by_chunk = {}
+    for frame, (chunk, offset, size) in index['frames'].items():
+        by_chunk.setdefault(chunk, []).append((offset, size, frame))
+
+    written = []
+    for chunk, chunk_frames in sorted(by_chunk.items()):
+        data = bucket.blob(chunk_name(cloud_path, chunk)).download_as_bytes()
+        for offset, size, frame in chunk_frames:
+            local_file_path = os.path.join(local_root_path, *frame.split('/'))
+            if os.path.exists(local_file_path) and os.path.getsize(local_file_path) == size:
+                continue
+            os.makedirs(os.path.dirname(local_file_path), exist_ok=True)
+            tmp_path = local_file_path + '.part'
+            with open(tmp_path, 'wb') as f:
+                f.write(data[offset:offset + size])
+            os.replace(tmp_path, local_file_path)
+            written.append(local_file_path)
+    return written
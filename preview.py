@@ -0,0 +1,67 @@
+import os
+import cv2
+
+
+PREVIEW_ROOT = "previews"
+PREVIEW_FACTORS = (2, 4, 16)
+
+
+def build_gaussian_pyramid(img, levels):
+    pyramid = [img]
+    for i in range(levels - 1):
+        img = cv2.pyrDown(img)
+        pyramid.append(img)
+    return pyramid
+
+def pyramid_level(factor):
+    '''
+    Pyramid level of a downsampling factor, each cv2.pyrDown halves both sides.
+    '''
+    level = factor.bit_length() - 1
+    if factor < 2 or 1 << level != factor:
+        raise ValueError(f"Preview factor {factor} is not a power of two")
+    return level
+
+def preview_local_path(local_path, factor):
+    '''
+    <job>/Acquire_0/<order> -> previews/<job>/Acquire_0/<order>/<factor>
+    '''
+    return os.path.join(PREVIEW_ROOT, local_path, str(factor))
+
+def preview_cloud_path(cloud_path, factor):
+    '''
+    Sibling prefix of the full resolution data: <job>/<well>/Primary -> <job>/<well>/Primary_preview/<factor>
+    '''
+    return cloud_path.replace('\\', '/').rstrip('/') + f"_preview/{factor}"
+
+def build_previews(local_path, factors=PREVIEW_FACTORS):
+    '''
+    Write downsampled PNG copies of every frame of a scan area, one folder per factor.
+    Every frame is decoded once and the pyramid is built once for all factors.
+    Previews newer than their source frame are kept as they are.
+    return: dict of factor -> local preview folder
+    '''
+    factors = sorted(factors)
+    levels = {factor: pyramid_level(factor) for factor in factors}
+    folders = {factor: preview_local_path(local_path, factor) for factor in factors}
+
+    for dirpath, dirnames, filenames in os.walk(local_path):
+        for filename in filenames:
+            if not filename.lower().endswith('.bmp'):
+                continue
+            source = os.path.join(dirpath, filename)
+            relative = os.path.splitext(os.path.relpath(source, local_path))[0] + '.png'
+            targets = {factor: os.path.join(folders[factor], relative) for factor in factors}
+            source_mtime = os.path.getmtime(source)
+            if all(os.path.exists(target) and os.path.getmtime(target) >= source_mtime for target in targets.values()):
+                continue
+
+            image = cv2.imread(source, cv2.IMREAD_UNCHANGED)
+            if image is None:
+                continue
+            pyramid = build_gaussian_pyramid(image, levels[factors[-1]] + 1)
+            for factor, target in targets.items():
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                cv2.imwrite(target, pyramid[levels[factor]])
+
+    return folders
@@ -0,0 +1,145 @@
+import numpy as np
+from stack_loader import load_stack
+
+# scipy.fft keeps float32 input in single precision and can use several threads,
+# numpy.fft is the fallback and always computes in double precision
+try:
+    import scipy.fft as fft_backend
+    FFT_KWARGS = {'workers': -1}
+except ImportError:
+    fft_backend = np.fft
+    FFT_KWARGS = {}
+
+
+def frame_spectra(frames, real=True, float32=True):
+    '''
+    FFT of every frame of a (n, h, w) stack in one batched call.
+    real: use rfft2, which stores only half of the spectrum of a real image
+    float32: compute in single precision, halves the memory of the spectra
+    '''
+    frames = np.asarray(frames, dtype=np.float32 if float32 else np.float64)
+    if real:
+        return fft_backend.rfft2(frames, axes=(-2, -1), **FFT_KWARGS)
+    return fft_backend.fft2(frames, axes=(-2, -1), **FFT_KWARGS)
+
+def cross_power_spectra(spectra_a, spectra_b, eps=1e-12):
+    '''
+    Normalised cross-power spectrum A * conj(B) / |A * conj(B)| for stacked spectra.
+    eps keeps frequencies with zero energy from dividing by zero.
+    '''
+    cross_power = spectra_a * np.conj(spectra_b)
+    cross_power /= np.abs(cross_power) + eps
+    return cross_power
+
+def correlation_surfaces(cross_power, shape, real=True):
+    '''
+    Back to the spatial domain, the peak of each surface is the shift between the pair.
+    '''
+    if real:
+        return fft_backend.irfft2(cross_power, s=shape, axes=(-2, -1), **FFT_KWARGS)
+    return fft_backend.ifft2(cross_power, axes=(-2, -1), **FFT_KWARGS).real
+
+def peak_shifts(surfaces):
+    '''
+    Integer shift of the highest peak of each (h, w) surface,
+    unwrapped from the FFT wraparound to a signed shift.
+    return: (n, 2) int array of (dy, dx)
+    '''
+    n, height, width = surfaces.shape
+    peaks = np.argmax(surfaces.reshape(n, -1), axis=1)
+    dy, dx = np.unravel_index(peaks, (height, width))
+    dy = np.where(dy <= height // 2, dy, dy - height)
+    dx = np.where(dx <= width // 2, dx, dx - width)
+    return np.stack([dy, dx], axis=1)
+
+def upsampled_correlation(cross_power, shape, coarse_shift, upsample_factor, region_size=None, real=True):
+    '''
+    Evaluate the inverse DFT of one cross-power spectrum on a fine grid around the coarse peak.
+
+    The fine grid is computed directly with two matrix multiplies, the DFT kernels only
+    cover region_size points per axis (1.5 pixels at the upsampled resolution by default),
+    so the cost is O(region_size * h * w) instead of zero-padding the whole spectrum.
+    For real spectra (rfft2) the missing half is folded in by Hermitian symmetry.
+    return: (region_size, region_size) real surface, y positions, x positions
+    '''
+    height, width = shape
+    if region_size is None:
+        region_size = int(np.ceil(upsample_factor * 1.5))
+    dftshift = np.fix(region_size / 2.0)
+    steps = (np.arange(region_size) - dftshift) / upsample_factor
+    ys = coarse_shift[0] + steps
+    xs = coarse_shift[1] + steps
+
+    if real:
+        kx = np.fft.rfftfreq(width)
+        # every column except DC (and Nyquist for even widths) stands for itself and its mirror
+        weights = np.full(len(kx), 2.0)
+        weights[0] = 1.0
+        if width % 2 == 0:
+            weights[-1] = 1.0
+        cross_power = cross_power * weights.astype(cross_power.real.dtype)
+    else:
+        kx = np.fft.fftfreq(width)
+    ky = np.fft.fftfreq(height)
+
+    kernel_y = np.exp(2j * np.pi * np.outer(ys, ky)).astype(cross_power.dtype)
+    kernel_x = np.exp(2j * np.pi * np.outer(kx, xs)).astype(cross_power.dtype)
+    surface = (kernel_y @ cross_power @ kernel_x).real / (height * width)
+    return surface, ys, xs
+
+def refine_shift(cross_power, shape, coarse_shift, upsample_factor, real=True):
+    '''
+    Sub-pixel shift of one pair, to within 1 / upsample_factor of a pixel.
+    return: (dy, dx) floats, peak confidence
+    '''
+    surface, ys, xs = upsampled_correlation(cross_power, shape, coarse_shift, upsample_factor, real=real)
+    row, column = np.unravel_index(np.argmax(surface), surface.shape)
+    return (ys[row], xs[column]), surface[row, column]
+
+def phase_correlation_shifts(frames, real=True, float32=True, batch_size=8, eps=1e-12, upsample_factor=1, return_confidence=False):
+    '''
+    Shift of every frame of a stack relative to the frame before it.
+
+    Each frame is transformed once and all neighbour cross-power spectra of a batch
+    are computed as one stacked array operation. batch_size bounds how many spectra
+    are held at once, the last spectrum of a batch is carried over to the next.
+    upsample_factor: above 1 every integer peak is refined to 1 / upsample_factor of a pixel
+    return_confidence: also return the height of each correlation peak, 1.0 for a perfect
+                       match and close to 0 when the pair has nothing in common
+    return: (n, 2) array of (dy, dx), int unless upsampled, the first row is (0, 0)
+            and, with return_confidence, an (n,) array of peak heights (1.0 for the first frame)
+    '''
+    n = len(frames)
+    shape = np.shape(frames[0])
+    shifts = np.zeros((n, 2), dtype=float if upsample_factor > 1 else int)
+    confidence = np.ones(n)
+    previous = None
+    for start in range(0, n, batch_size):
+        spectra = frame_spectra(frames[start:start + batch_size], real, float32)
+        if previous is not None:
+            spectra_a = np.concatenate([previous[np.newaxis], spectra[:-1]])
+            spectra_b = spectra
+            first = start
+        else:
+            spectra_a, spectra_b = spectra[:-1], spectra[1:]
+            first = start + 1
+        if len(spectra_b):
+            cross_power = cross_power_spectra(spectra_a, spectra_b, eps)
+            surfaces = correlation_surfaces(cross_power, shape, real)
+            coarse = peak_shifts(surfaces)
+            for i, (dy, dx) in enumerate(coarse):
+                if upsample_factor > 1:
+                    shifts[first + i], confidence[first + i] = refine_shift(cross_power[i], shape, (dy, dx), upsample_factor, real)
+                else:
+                    shifts[first + i] = (dy, dx)
+                    confidence[first + i] = surfaces[i, dy % shape[0], dx % shape[1]]
+        previous = spectra[-1]
+    if return_confidence:
+        return shifts, confidence
+    return shifts
+
+def register_scan_area(local_path, repetition=0, **kwargs):
+    '''
+    Shift table of one repetition of a scan area, e.g. the local paths built by generate_paths.
+    '''
+    return phase_correlation_shifts(load_stack(local_path, repetition), **kwargs)
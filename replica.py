@@ -0,0 +1,189 @@
+import os
+import re
+import sqlite3
+import datetime
+import decimal
+import threading
+
+
+SCHEMA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "create_tables.sql")
+
+# replicated tables and the key their rows are synced by, in the order they are synced
+REPLICA_TABLES = [
+    ("Job", "Id"),
+    ("JobTask", "Id"),
+    ("JobEvent", "Id"),
+    ("AcquireTask", "JobTask_id"),
+    ("AcquireSettings", "Id"),
+    ("InstrumentInformation", "Id"),
+    ("ScanArea", "Id"),
+    ("Scan", "Id"),
+    ("PathStorage", "id"),
+]
+
+
+def sqlite_schema(sql):
+    '''
+    Translate create_tables.sql to SQLite: the CREATE TABLE and CREATE INDEX statements only,
+    AUTO_INCREMENT keys as INTEGER, without FULLTEXT indexes and foreign keys. SQLite index names are global,
+    so every index is prefixed with its table (IX_AcquireSettings exists on two tables).
+    '''
+    statements = []
+    for statement in sql.split(';'):
+        lines = [line for line in statement.splitlines() if not line.strip().startswith('--')]
+        statement = '\n'.join(lines).strip()
+        if statement.upper().startswith('CREATE TABLE'):
+            # INTEGER keys become rowid aliases, so rows inserted without an id still get one
+            statement = re.sub(r'\bINT(\s+NOT NULL)?\s+AUTO_INCREMENT', r'INTEGER\1', statement, flags=re.IGNORECASE)
+            statement = re.sub(r'^CREATE TABLE', 'CREATE TABLE IF NOT EXISTS', statement, flags=re.IGNORECASE)
+            statements.append(statement)
+        elif statement.upper().startswith('CREATE INDEX'):
+            match = re.match(r'CREATE INDEX (\w+) ON (\w+)\s*(\(.*\))', statement, flags=re.IGNORECASE | re.DOTALL)
+            name, table, columns = match.groups()
+            statements.append(f"CREATE INDEX IF NOT EXISTS {table}_{name} ON {table} {columns}")
+    return ';\n'.join(statements) + ';'
+
+def sqlite_value(value):
+    '''
+    MySQL and SQLCE values SQLite can't store as they are.
+    '''
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat(' ')
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    return value
+
+def escape_like(term):
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def fulltext_words(text):
+    '''
+    Words of text split like the MySQL FULLTEXT parser does, at every character other than letters, digits and _.
+    '''
+    return ''.join(c if c.isalnum() or c == '_' else ' ' for c in text or "").split()
+
+def name_words(name):
+    '''
+    ' word1 word2' of a job name, so name_words(Name) LIKE '% term%' matches a term at the start of any word.
+    '''
+    return ''.join(f" {word}" for word in fulltext_words(name))
+
+
+class MetadataReplica:
+    '''
+    Local SQLite copy of the create_tables.sql schema, so job searches and path lookups
+    take milliseconds and keep working when Cloud SQL can't be reached.
+
+    sync() is incremental: the high-water marks are the largest key already copied
+    per table and the latest Job.ModifiedTimeUtc, both read back from the replica itself.
+    '''
+
+    def __init__(self, filename='metadata_replica.db', schema_file=SCHEMA_FILE):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.create_function("name_words", 1, name_words, deterministic=True)
+        with open(schema_file) as f:
+            self.connection.executescript(sqlite_schema(f.read()))
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def high_water_mark(self, table, key):
+        row = self.connection.execute(f"SELECT MAX({key}) FROM {table}").fetchone()
+        return row[0] if row[0] is not None else 0
+
+    def last_modified(self):
+        row = self.connection.execute("SELECT MAX(ModifiedTimeUtc) FROM Job").fetchone()
+        return row[0]
+
+    def _copy(self, cursor, table, batch_size):
+        '''
+        Copy the rows of an executed SELECT * into the replica, replacing rows with the same key.
+        '''
+        columns = [description[0] for description in cursor.description]
+        query = f"INSERT OR REPLACE INTO {table} ({', '.join(columns)}) VALUES ({', '.join(['?'] * len(columns))})"
+        count = 0
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return count
+            with self._lock:
+                self.connection.executemany(query, [[sqlite_value(value) for value in row] for row in rows])
+            count += len(rows)
+
+    def sync(self, cursor, children=(), placeholder='%s', batch_size=1000, tables=REPLICA_TABLES):
+        '''
+        Pull what changed since the last sync from a MySQL (or SQLCE, placeholder='?') cursor.
+        New rows of every table are selected by key above the replica's high-water mark.
+        Jobs modified since the latest ModifiedTimeUtc are copied again together with their
+        child rows, selected like cloud.py does with children: [(table, column)].
+        return: dict of table -> rows copied
+        '''
+        counts = {}
+        last_modified = self.last_modified()
+        for table, key in tables:
+            cursor.execute(f"SELECT * FROM {table} WHERE {key} > {placeholder} ORDER BY {key}", (self.high_water_mark(table, key),))
+            counts[table] = self._copy(cursor, table, batch_size)
+
+        if last_modified is not None:
+            cursor.execute(f"SELECT * FROM Job WHERE ModifiedTimeUtc >= {placeholder}", (last_modified,))
+            columns = [description[0] for description in cursor.description]
+            modified = cursor.fetchall()
+            if modified:
+                query = f"INSERT OR REPLACE INTO Job ({', '.join(columns)}) VALUES ({', '.join(['?'] * len(columns))})"
+                with self._lock:
+                    self.connection.executemany(query, [[sqlite_value(value) for value in row] for row in modified])
+                counts["Job"] += len(modified)
+                for job in modified:
+                    for table, column in children:
+                        cursor.execute(f"SELECT * FROM {table} WHERE {column} = {placeholder}", (job[0],))
+                        counts[table] = counts.get(table, 0) + self._copy(cursor, table, batch_size)
+
+        with self._lock:
+            self.connection.commit()
+        return counts
+
+    # lookups
+    def search_jobs(self, search_term="", after_id=0, limit=100, mode='prefix'):
+        '''
+        Same pages as cloud.search_jobs, read from the replica.
+        'fulltext' requires every word of the term as the prefix of a word of the name, like the
+        boolean mode MATCH on Cloud SQL.
+        '''
+        if not search_term:
+            where, params = "", []
+        elif mode == 'fulltext':
+            words = fulltext_words(search_term)
+            # no words matches nothing, like an empty AGAINST
+            where = ''.join(" AND name_words(Name) LIKE ? ESCAPE '\\'" for _ in words) or " AND 0"
+            params = [f"% {escape_like(word)}%" for word in words]
+        elif mode == 'contains':
+            where, params = " AND Name LIKE ? ESCAPE '\\'", [f"%{escape_like(search_term)}%"]
+        elif mode == 'prefix':
+            where, params = " AND Name LIKE ? ESCAPE '\\'", [f"{escape_like(search_term)}%"]
+        else:
+            raise ValueError(f"Unknown job search mode {mode}")
+        return self.connection.execute(f"SELECT Id, Name FROM Job WHERE Id > ?{where} ORDER BY Id LIMIT ?",
+                                       (after_id, *params, limit)).fetchall()
+
+    def job_paths(self, job_id, level=0):
+        '''
+        (cloud_path, local_path) of a job, like the PathStorage query of download_from_cloud.
+        '''
+        return self.connection.execute("SELECT cloud_path, local_path FROM PathStorage WHERE job_id = ? AND level = ?",
+                                       (int(job_id), level)).fetchall()
+
+
+def open_replica(filename):
+    '''
+    Open the replica, None keeps every lookup on Cloud SQL.
+    '''
+    if not filename:
+        return None
+    directory = os.path.dirname(filename)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    return MetadataReplica(filename)
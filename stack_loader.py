@@ -0,0 +1,87 @@
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+
+
+def numeric_names(folder, suffix=''):
+    '''
+    Entries of a folder whose name (without suffix) is a number, sorted numerically.
+    '''
+    names = []
+    for name in os.listdir(folder):
+        if not name.lower().endswith(suffix):
+            continue
+        stem = name[:len(name) - len(suffix)]
+        if stem.isdigit():
+            names.append((int(stem), name))
+    return [name for _, name in sorted(names)]
+
+def list_repetitions(local_path):
+    '''
+    Repetition indices of a scan area, <job>/Acquire_0/<order>/<rep>/ as built by generate_paths.
+    '''
+    return [int(name) for name in numeric_names(local_path) if os.path.isdir(os.path.join(local_path, name))]
+
+def list_frames(local_path, repetition):
+    '''
+    Frame files of one repetition in z order, <rep>/0.bmp, <rep>/1.bmp, ...
+    '''
+    folder = os.path.join(local_path, str(repetition))
+    return [os.path.join(folder, name) for name in numeric_names(folder, '.bmp')]
+
+def read_into(path, out):
+    '''
+    Decode one frame into its slot of the preallocated stack.
+    cv2 releases the GIL while decoding, so several of these run in parallel.
+    '''
+    image = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        raise IOError(f"Could not read image {path}")
+    out[...] = image
+
+def load_stack(local_path, repetition=0, workers=8, executor=None, out=None):
+    '''
+    Load the z-stack of one repetition as a (z, h, w) uint8 array.
+    Frames are decoded by a thread pool straight into one preallocated array,
+    so the stack is never copied a second time.
+    executor: shared ThreadPoolExecutor, a private one with `workers` threads is used if None
+    out: preallocated (z, h, w) uint8 array to reuse between stacks
+    '''
+    paths = list_frames(local_path, repetition)
+    if not paths:
+        return np.empty((0, 0, 0), dtype=np.uint8)
+    if out is None or len(out) != len(paths):
+        first = cv2.imread(paths[0], cv2.IMREAD_GRAYSCALE)
+        if first is None:
+            raise IOError(f"Could not read image {paths[0]}")
+        out = np.empty((len(paths),) + first.shape, dtype=np.uint8)
+
+    if executor is None:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(read_into, paths, out))
+    else:
+        list(executor.map(read_into, paths, out))
+    return out
+
+def iter_stacks(local_path, repetitions=None, workers=8, prefetch=1):
+    '''
+    Yield (repetition, stack) for every repetition of a scan area,
+    decoding the next `prefetch` stacks in the background while the current one is processed.
+    '''
+    if repetitions is None:
+        repetitions = list_repetitions(local_path)
+    with ThreadPoolExecutor(max_workers=workers) as decoder, ThreadPoolExecutor(max_workers=max(prefetch, 1)) as prefetcher:
+        queue = deque()
+        pending = iter(repetitions)
+        for repetition in pending:
+            queue.append((repetition, prefetcher.submit(load_stack, local_path, repetition, executor=decoder)))
+            if len(queue) >= max(prefetch, 1):
+                break
+        while queue:
+            repetition, future = queue.popleft()
+            for next_repetition in pending:
+                queue.append((next_repetition, prefetcher.submit(load_stack, local_path, next_repetition, executor=decoder)))
+                break
+            yield repetition, future.result()
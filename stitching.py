@@ -0,0 +1,97 @@
+import numpy as np
+from tiled import create_tiled
+
+
+def mosaic_geometry(frame_shape, shifts):
+    '''
+    Place every frame on the canvas from the shift table of registration.phase_correlation_shifts.
+    Each shift is relative to the frame before it; sub-pixel shifts are rounded to whole pixels.
+    return: (n, 2) int array of (y, x) top-left positions, (height, width) of the canvas
+    '''
+    positions = np.cumsum(np.rint(np.asarray(shifts, dtype=float)).astype(int), axis=0)
+    positions -= positions.min(axis=0)
+    height = int(positions[:, 0].max()) + frame_shape[0]
+    width = int(positions[:, 1].max()) + frame_shape[1]
+    return positions, (height, width)
+
+def feather_ramp(length, rising, axis, dtype=np.float32):
+    '''
+    1-D weight of the new frame across an overlap, shaped to broadcast along the other axis.
+    '''
+    ramp = (np.arange(length, dtype=dtype) + 0.5) / length
+    if not rising:
+        ramp = ramp[::-1]
+    return ramp[:, np.newaxis] if axis == 0 else ramp[np.newaxis, :]
+
+def blend_frame(canvas, frame, position, previous_position, buffer):
+    '''
+    Write one frame into the canvas in place, feathering it with the previous frame.
+
+    Only the rectangle shared with the previous frame is blended, with a linear 1-D ramp
+    along the direction of the shift. buffer is a float32 array at least the size of a
+    frame and is reused between frames, so no full-size masks are allocated.
+    '''
+    height, width = frame.shape[:2]
+    y, x = position
+
+    blended = None
+    if previous_position is not None:
+        py, px = previous_position
+        top, bottom = max(y, py), min(y, py) + height
+        left, right = max(x, px), min(x, px) + width
+        if bottom > top and right > left:
+            dy, dx = y - py, x - px
+            axis = 0 if abs(dy) >= abs(dx) else 1
+            rising = (dy if axis == 0 else dx) >= 0
+            ramp = feather_ramp(bottom - top if axis == 0 else right - left, rising, axis)
+
+            old = canvas[top:bottom, left:right]
+            new = frame[top - y:bottom - y, left - x:right - x]
+            blended = buffer[:bottom - top, :right - left]
+            # blended = old + ramp * (new - old)
+            np.subtract(new, old, out=blended, dtype=np.float32)
+            np.multiply(blended, ramp, out=blended)
+            np.add(blended, old, out=blended)
+            np.rint(blended, out=blended)
+
+    canvas[y:y + height, x:x + width] = frame
+    if blended is not None:
+        canvas[top:bottom, left:right] = blended
+    return canvas
+
+def stitch(frames, shifts, out=None):
+    '''
+    Composite a stack of frames into one mosaic with feathered overlaps.
+
+    frames: (n, h, w) uint8 stack or any sequence of equally sized uint8 frames
+    shifts: (n, 2) shift table, each row relative to the previous frame
+    out: preallocated uint8 canvas (or any array supporting slice assignment, e.g. a memmap),
+         allocated here if None
+    return: the canvas
+    '''
+    frame_shape = np.shape(frames[0])
+    positions, canvas_shape = mosaic_geometry(frame_shape, shifts)
+    if out is None:
+        out = np.zeros(canvas_shape, dtype=np.uint8)
+    elif tuple(out.shape[:2]) != canvas_shape:
+        raise ValueError(f"Canvas of shape {out.shape} does not fit a mosaic of shape {canvas_shape}")
+
+    buffer = np.empty(frame_shape[:2], dtype=np.float32)
+    previous_position = None
+    for frame, position in zip(frames, positions):
+        blend_frame(out, frame, position, previous_position, buffer)
+        previous_position = position
+    return out
+
+def stitch_to_tiles(frames, shifts, path, chunks=(1024, 1024)):
+    '''
+    Stitch straight into a tiled on-disk mosaic instead of an in-memory canvas.
+    Frames are written to their tiles as they are blended, so memory stays at a few tiles
+    and one frame no matter how large the mosaic is.
+    return: the TiledArray, closed and flushed
+    '''
+    _, canvas_shape = mosaic_geometry(np.shape(frames[0]), shifts)
+    mosaic = create_tiled(path, canvas_shape, chunks)
+    stitch(frames, shifts, out=mosaic)
+    mosaic.close()
+    return mosaic
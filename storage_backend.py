@@ -0,0 +1,349 @@
+import os
+import shutil
+import base64
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import google_crc32c
+
+
+# GCS composes at most 32 objects in one request
+MAX_COMPOSE_SOURCES = 32
+
+
+def file_crc32c(local_file):
+    '''
+    base64 encoded CRC32C of a local file, the same encoding GCS uses for blob.crc32c.
+    '''
+    checksum = google_crc32c.Checksum()
+    with open(local_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            checksum.update(chunk)
+    return base64.b64encode(checksum.digest()).decode('utf-8')
+
+def chunk_ranges(size, chunk_bytes):
+    '''
+    (offset, length) of every chunk of a file of size bytes.
+    '''
+    return [(offset, min(chunk_bytes, size - offset)) for offset in range(0, size, chunk_bytes)]
+
+
+class StorageBackend:
+    '''
+    Object store the migration reads and writes, in place of a storage.Client.
+
+    bucket() returns a bucket with the subset of the google.cloud.storage Bucket and Blob API
+    cloud.py and pack.py use: blob(), get_blob(), list_blobs(prefix), upload_from_filename/file/string,
+    download_to_filename, download_as_bytes(start, end), exists(), reload() and the size,
+    crc32c and generation of a blob. Whole files go through upload() and download(), so a backend
+    can move large files its own way.
+    '''
+
+    def bucket(self, bucket_name):
+        raise NotImplementedError
+
+    def list_buckets(self):
+        raise NotImplementedError
+
+    def upload(self, bucket, local_file, cloud_path):
+        '''
+        Store local_file as cloud_path.
+        return: the blob, with its size, crc32c and generation filled in
+        '''
+        blob = bucket.blob(cloud_path)
+        blob.upload_from_filename(local_file)
+        return blob
+
+    def download(self, blob, filename):
+        blob.download_to_filename(filename)
+
+    def close(self):
+        pass
+
+
+class GCSBackend(StorageBackend):
+    '''
+    Google Cloud Storage through one shared storage.Client.
+
+    Files above chunk_bytes are uploaded as parallel parts that are composed into the final object
+    and deleted again, and downloaded with parallel range requests written into place, so a single
+    large file such as e96_wells uses more than one connection. The chunks of every file
+    share one pool of workers threads.
+    '''
+
+    def __init__(self, service_account_file_path, chunk_bytes=32 * 1024 * 1024, workers=8):
+        # imported here so the local backend runs without the GCS client library
+        from google.cloud import storage
+        self.client = storage.Client.from_service_account_json(service_account_file_path)
+        self.chunk_bytes = chunk_bytes
+        self.workers = workers
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def bucket(self, bucket_name):
+        return self.client.bucket(bucket_name)
+
+    def list_buckets(self):
+        return list(self.client.list_buckets())
+
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='chunk')
+            return self._executor
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def chunked(self, size):
+        return bool(self.chunk_bytes) and self.workers > 1 and size > self.chunk_bytes
+
+    def upload(self, bucket, local_file, cloud_path):
+        size = os.path.getsize(local_file)
+        if not self.chunked(size):
+            return super().upload(bucket, local_file, cloud_path)
+
+        def upload_part(part, offset, length):
+            with open(local_file, 'rb') as f:
+                f.seek(offset)
+                part.upload_from_file(f, size=length, rewind=False)
+
+        ranges = chunk_ranges(size, self.chunk_bytes)
+        parts = [bucket.blob(f"{cloud_path}.part{index:05d}") for index in range(len(ranges))]
+        temporary = list(parts)
+        try:
+            list(self.executor().map(lambda part, chunk: upload_part(part, *chunk), parts, ranges))
+            blob = self.compose(bucket, cloud_path, parts, temporary)
+        finally:
+            bucket.delete_blobs(temporary, on_error=lambda blob: None)
+
+        if blob.size != size or blob.crc32c != file_crc32c(local_file):
+            raise IOError(f"Composed object {cloud_path} does not match {local_file}")
+        return blob
+
+    def compose(self, bucket, cloud_path, sources, temporary):
+        '''
+        Combine sources into cloud_path, through intermediate objects when there are more than
+        MAX_COMPOSE_SOURCES of them. Intermediate objects are appended to temporary.
+        '''
+        tier = 0
+        while len(sources) > MAX_COMPOSE_SOURCES:
+            groups = [sources[i:i + MAX_COMPOSE_SOURCES] for i in range(0, len(sources), MAX_COMPOSE_SOURCES)]
+            composed = [bucket.blob(f"{cloud_path}.compose{tier}_{index:05d}") for index in range(len(groups))]
+            temporary.extend(composed)
+            list(self.executor().map(lambda blob, group: blob.compose(group), composed, groups))
+            sources = composed
+            tier += 1
+        blob = bucket.blob(cloud_path)
+        blob.compose(sources)
+        return blob
+
+    def download(self, blob, filename):
+        if blob.size is None:
+            blob.reload()
+        if not self.chunked(blob.size):
+            return super().download(blob, filename)
+
+        # every range reads the same generation, even if the object is replaced meanwhile
+        def download_range(offset, length):
+            source = blob.bucket.blob(blob.name, generation=blob.generation)
+            data = source.download_as_bytes(start=offset, end=offset + length - 1, checksum=None)
+            with open(filename, 'r+b') as f:
+                f.seek(offset)
+                f.write(data)
+
+        with open(filename, 'wb') as f:
+            f.truncate(blob.size)
+        list(self.executor().map(lambda chunk: download_range(*chunk), chunk_ranges(blob.size, self.chunk_bytes)))
+        if blob.crc32c and file_crc32c(filename) != blob.crc32c:
+            raise IOError(f"crc32c mismatch after downloading {blob.name}")
+
+
+class LocalBlob:
+    '''
+    Object of a LocalBucket, a plain file under the bucket directory.
+    size and generation (modification time in ns) come from a stat once the object exists.
+    crc32c (base64, like GCS) is only computed when it is read, and kept in the bucket's
+    cache, so listing a mirror does not read the files.
+    '''
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.path = os.path.join(bucket.root, *name.split('/'))
+        self.size = self.generation = None
+        self._crc32c = None
+
+    @property
+    def crc32c(self):
+        if self._crc32c is None and self.generation is not None:
+            self._crc32c = self.bucket.cached_crc32c(self.name, self.size, self.generation)
+            if self._crc32c is None:
+                self._crc32c = file_crc32c(self.path)
+                self.bucket.cache_crc32c(self.name, self.size, self.generation, self._crc32c)
+        return self._crc32c
+
+    def _stored(self, crc32c=None):
+        self.reload()
+        if crc32c is not None:
+            self._crc32c = crc32c
+            self.bucket.cache_crc32c(self.name, self.size, self.generation, crc32c)
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def reload(self):
+        stat = os.stat(self.path)
+        if stat.st_mtime_ns != self.generation or stat.st_size != self.size:
+            self._crc32c = None
+        self.size, self.generation = stat.st_size, stat.st_mtime_ns
+
+    def upload_from_filename(self, filename, **kwargs):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        shutil.copyfile(filename, self.path)
+        self._stored()
+
+    def upload_from_string(self, data, **kwargs):
+        self.upload_from_file(None, data=data.encode('utf-8') if isinstance(data, str) else data)
+
+    def upload_from_file(self, file_obj, data=None, size=None, **kwargs):
+        data = file_obj.read(size) if data is None else data
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'wb') as f:
+            f.write(data)
+        self._stored(base64.b64encode(google_crc32c.Checksum(data).digest()).decode('utf-8'))
+
+    def download_to_filename(self, filename, **kwargs):
+        shutil.copyfile(self.path, filename)
+
+    def download_as_bytes(self, start=None, end=None, **kwargs):
+        with open(self.path, 'rb') as f:
+            if start is None:
+                return f.read()
+            f.seek(start)
+            return f.read(None if end is None else end - start + 1)
+
+    def delete(self):
+        os.remove(self.path)
+        self.bucket.cache_crc32c(self.name, None, None, None)
+
+
+class LocalBucket:
+    '''
+    Directory of objects. The crc32c of every object is cached by (name, size, generation)
+    in <root>.crc32c.db next to the directory, so each file is hashed once, not on every run.
+    '''
+
+    def __init__(self, root, name):
+        self.root = root
+        self.name = name
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self.cache = sqlite3.connect(root.rstrip(os.sep) + '.crc32c.db', check_same_thread=False)
+        # losing the last writes only costs hashing those files again
+        self.cache.execute("PRAGMA journal_mode=WAL")
+        self.cache.execute("PRAGMA synchronous=NORMAL")
+        self.cache.execute("CREATE TABLE IF NOT EXISTS crc32c (name TEXT PRIMARY KEY, size INTEGER, generation INTEGER, crc32c TEXT)")
+        self.cache.commit()
+
+    def close(self):
+        self.cache.close()
+
+    def cached_crc32c(self, name, size, generation):
+        with self.lock:
+            row = self.cache.execute("SELECT crc32c FROM crc32c WHERE name = ? AND size = ? AND generation = ?",
+                                     (name, size, generation)).fetchone()
+        return row[0] if row else None
+
+    def cache_crc32c(self, name, size, generation, crc32c):
+        '''
+        Remember the crc32c of an object, None forgets it.
+        '''
+        with self.lock:
+            if crc32c is None:
+                self.cache.execute("DELETE FROM crc32c WHERE name = ?", (name,))
+            else:
+                self.cache.execute("INSERT OR REPLACE INTO crc32c (name, size, generation, crc32c) VALUES (?, ?, ?, ?)",
+                                   (name, size, generation, crc32c))
+            self.cache.commit()
+
+    def blob(self, name, generation=None):
+        # a directory holds one generation of every object
+        return LocalBlob(self, name)
+
+    def get_blob(self, name):
+        blob = LocalBlob(self, name)
+        if not blob.exists():
+            return None
+        blob.reload()
+        return blob
+
+    def list_blobs(self, prefix=''):
+        '''
+        Objects whose name starts with prefix, only the directory of the prefix is walked.
+        '''
+        folder = os.path.join(self.root, *prefix.split('/')[:-1])
+        blobs = []
+        for dirpath, _, filenames in os.walk(folder):
+            for filename in filenames:
+                name = os.path.relpath(os.path.join(dirpath, filename), self.root).replace(os.sep, '/')
+                if name.startswith(prefix):
+                    blob = LocalBlob(self, name)
+                    blob.reload()
+                    blobs.append(blob)
+        return sorted(blobs, key=lambda blob: blob.name)
+
+    def delete_blobs(self, blobs, on_error=None):
+        for blob in blobs:
+            try:
+                blob.delete()
+            except FileNotFoundError:
+                if on_error is None:
+                    raise
+                on_error(blob)
+
+
+class LocalBackend(StorageBackend):
+    '''
+    Every bucket is a directory under root, for offline runs and on-prem mirrors.
+    The object names map onto the same folder layout the jobs have in GCS.
+    '''
+
+    def __init__(self, root):
+        self.root = root
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, bucket_name):
+        with self._lock:
+            if bucket_name not in self._buckets:
+                self._buckets[bucket_name] = LocalBucket(os.path.join(self.root, bucket_name), bucket_name)
+            return self._buckets[bucket_name]
+
+    def list_buckets(self):
+        names = sorted(os.listdir(self.root)) if os.path.isdir(self.root) else []
+        return [self.bucket(name) for name in names if os.path.isdir(os.path.join(self.root, name))]
+
+    def list_blobs(self, bucket_name, prefix=''):
+        return self.bucket(bucket_name).list_blobs(prefix=prefix)
+
+    def close(self):
+        with self._lock:
+            for bucket in self._buckets.values():
+                bucket.close()
+            self._buckets.clear()
+
+
+def open_storage(backend, service_account_file_path=None, root=None, chunk_bytes=32 * 1024 * 1024, workers=8):
+    '''
+    backend: 'gcs' for the bucket of the service account, 'local' for directories under root
+    '''
+    if backend == 'gcs':
+        return GCSBackend(service_account_file_path, chunk_bytes, workers)
+    if backend == 'local':
+        if not root:
+            raise ValueError("The local storage backend needs a root directory")
+        return LocalBackend(root)
+    raise ValueError(f"Unknown storage backend {backend}")
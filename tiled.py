@@ -0,0 +1,132 @@
+import os
+import json
+from collections import OrderedDict
+import numpy as np
+
+
+METADATA_NAME = ".zarray"
+
+
+class TiledArray:
+    '''
+    2-D uint8 array stored as a directory of fixed-size tiles, each one memory-mapped on demand.
+
+    The layout is a plain Zarr v2 array without compression: a ".zarray" metadata file and one
+    raw C-order file per chunk named "<row>.<column>". Tiles are only created when something is
+    written to them, untouched tiles read as zeros, and at most max_open tiles are mapped at once,
+    so a plate-sized mosaic never has to fit in memory. Every tile is an ordinary file, so the
+    whole directory can be uploaded with copy_to_cloud like any scan area.
+    '''
+
+    def __init__(self, path, shape=None, chunks=(1024, 1024), max_open=64):
+        self.path = path
+        self.max_open = max_open
+        self._open = OrderedDict()
+        metadata_file = os.path.join(path, METADATA_NAME)
+        if shape is None:
+            with open(metadata_file) as f:
+                metadata = json.load(f)
+            if metadata['dtype'] != '|u1':
+                raise ValueError(f"{path} holds {metadata['dtype']} data, only uint8 mosaics are supported")
+            shape, chunks = metadata['shape'], metadata['chunks']
+        else:
+            os.makedirs(path, exist_ok=True)
+            metadata = {
+                'zarr_format': 2,
+                'shape': list(shape),
+                'chunks': list(chunks),
+                'dtype': '|u1',
+                'compressor': None,
+                'fill_value': 0,
+                'filters': None,
+                'order': 'C',
+            }
+            with open(metadata_file, 'w') as f:
+                json.dump(metadata, f, indent=4)
+        self.shape = tuple(shape)
+        self.chunks = tuple(chunks)
+        self.dtype = np.dtype(np.uint8)
+
+    def tile_path(self, row, column):
+        return os.path.join(self.path, f"{row}.{column}")
+
+    def _tile(self, row, column, create):
+        key = (row, column)
+        if key in self._open:
+            self._open.move_to_end(key)
+            return self._open[key]
+        tile_path = self.tile_path(row, column)
+        if not os.path.exists(tile_path):
+            if not create:
+                return None
+            tile = np.memmap(tile_path, dtype=self.dtype, mode='w+', shape=self.chunks)
+        else:
+            tile = np.memmap(tile_path, dtype=self.dtype, mode='r+', shape=self.chunks)
+        self._open[key] = tile
+        if len(self._open) > self.max_open:
+            _, oldest = self._open.popitem(last=False)
+            oldest.flush()
+        return tile
+
+    def _tiles_in(self, rows, columns):
+        '''
+        Yield (row, column, tile slice, region slice) for every tile a rectangle touches.
+        '''
+        tile_h, tile_w = self.chunks
+        for row in range(rows.start // tile_h, (rows.stop - 1) // tile_h + 1):
+            y0, y1 = max(rows.start, row * tile_h), min(rows.stop, (row + 1) * tile_h)
+            for column in range(columns.start // tile_w, (columns.stop - 1) // tile_w + 1):
+                x0, x1 = max(columns.start, column * tile_w), min(columns.stop, (column + 1) * tile_w)
+                yield (row, column,
+                       (slice(y0 - row * tile_h, y1 - row * tile_h), slice(x0 - column * tile_w, x1 - column * tile_w)),
+                       (slice(y0 - rows.start, y1 - rows.start), slice(x0 - columns.start, x1 - columns.start)))
+
+    def _normalise(self, key):
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+        rows, columns = key
+        rows = slice(*rows.indices(self.shape[0]))
+        columns = slice(*columns.indices(self.shape[1]))
+        if rows.step != 1 or columns.step != 1:
+            raise IndexError("TiledArray only supports contiguous slices")
+        return rows, columns
+
+    def __getitem__(self, key):
+        rows, columns = self._normalise(key)
+        out = np.zeros((max(rows.stop - rows.start, 0), max(columns.stop - columns.start, 0)), dtype=self.dtype)
+        if out.size == 0:
+            return out
+        for row, column, tile_slice, region_slice in self._tiles_in(rows, columns):
+            tile = self._tile(row, column, create=False)
+            if tile is not None:
+                out[region_slice] = tile[tile_slice]
+        return out
+
+    def __setitem__(self, key, value):
+        rows, columns = self._normalise(key)
+        if rows.stop <= rows.start or columns.stop <= columns.start:
+            return
+        value = np.broadcast_to(np.asarray(value), (rows.stop - rows.start, columns.stop - columns.start))
+        for row, column, tile_slice, region_slice in self._tiles_in(rows, columns):
+            self._tile(row, column, create=True)[tile_slice] = value[region_slice]
+
+    def flush(self):
+        for tile in self._open.values():
+            tile.flush()
+
+    def close(self):
+        self.flush()
+        self._open.clear()
+
+    def tile_files(self):
+        '''
+        Paths of the tiles written so far, plus the metadata file.
+        '''
+        return [os.path.join(self.path, name) for name in sorted(os.listdir(self.path))]
+
+
+def create_tiled(path, shape, chunks=(1024, 1024)):
+    return TiledArray(path, shape, chunks)
+
+def open_tiled(path):
+    return TiledArray(path)
@@ -0,0 +1,61 @@
+# every enabled scan area with its job, the columns generate_paths builds the paths from
+WELL_QUERY = ("SELECT Job.Id, Job.Name, ScanArea.Name, ScanArea.OrderIndex FROM Job "
+              "INNER JOIN ScanArea ON ScanArea.AcquireSettings_id = Job.Id "
+              "WHERE ScanArea.Enabled = 1")
+
+
+def well_path(job_id, order_index):
+    '''
+    Local folder of a scan area, <job>/Acquire_0/<OrderIndex>
+    '''
+    return f"{job_id}/Acquire_0/{order_index}"
+
+def search_wells(cursor, search_term, well_name, placeholder='?'):
+    '''
+    Folders of the enabled wells called well_name in the jobs whose name contains search_term.
+    One joined query instead of a Job query plus two ScanArea queries per job.
+    placeholder: '?' for SQLCE and SQLite, '%s' for MySQL
+    '''
+    cursor.execute(f"{WELL_QUERY} AND Job.Name LIKE {placeholder} AND ScanArea.Name = {placeholder} "
+                   "ORDER BY Job.Id, ScanArea.OrderIndex", (f"%{search_term}%", well_name))
+    return [well_path(job_id, order_index) for job_id, _, _, order_index in cursor.fetchall()]
+
+
+class WellIndex:
+    '''
+    In-memory (well name) -> [(job_id, job_name, path)] index of every enabled scan area.
+
+    load() fills it with a single query, after that a search is a dict lookup plus a filter
+    on the job names of that well, and repeated searches are answered from a cache.
+    Names are compared case-insensitively, like LIKE and = do in SQLCE.
+    '''
+
+    def __init__(self, cursor=None):
+        self._wells = {}
+        self._cache = {}
+        if cursor is not None:
+            self.load(cursor)
+
+    def load(self, cursor):
+        cursor.execute(f"{WELL_QUERY} ORDER BY Job.Id, ScanArea.OrderIndex")
+        wells = {}
+        for job_id, job_name, well_name, order_index in cursor.fetchall():
+            wells.setdefault(str(well_name).upper(), []).append((job_id, job_name or "", well_path(job_id, order_index)))
+        self._wells = wells
+        self._cache.clear()
+        return self
+
+    def jobs(self, well_name):
+        '''
+        (job_id, job_name, path) of every job that has this well.
+        '''
+        return list(self._wells.get(str(well_name).upper(), []))
+
+    def find(self, search_term, well_name):
+        '''
+        Same result as search_wells, without touching the database.
+        '''
+        key = (search_term.lower(), str(well_name).upper())
+        if key not in self._cache:
+            self._cache[key] = [path for _, job_name, path in self._wells.get(key[1], []) if key[0] in job_name.lower()]
+        return list(self._cache[key])